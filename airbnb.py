@@ -17,15 +17,15 @@
 import logging
 import argparse
 import sys
-import time
 import webbrowser
 from lxml import html
 import psycopg2
 import psycopg2.errorcodes
 from airbnb_config import ABConfig
-from airbnb_survey import ABSurveyByBoundingBox
+from airbnb_survey import ABSurveyByBoundingBox, ABSurveyByBoundingBoxAsync
 from airbnb_survey import ABSurveyByNeighborhood, ABSurveyByZipcode
-from airbnb_listing import ABListing
+from airbnb_listing import ABListing, import_room_dump
+from airbnb_listing import ROOM_PARTITION, room_is_partitioned
 import airbnb_ws
 
 # ============================================================================
@@ -203,14 +203,30 @@ def db_delete_survey(config, survey_id):
         print("Cancelling the request.")
         return
     try:
+        partitioned = room_is_partitioned(config)
         conn = config.connect()
         cur = conn.cursor()
-        # Delete the listings from the room table
+        if partitioned:
+            # Drop the survey's partition of the room table: much quicker
+            # than deleting its listings one by one. It is created again
+            # if the survey is run again.
+            partition = ROOM_PARTITION.format(survey_id)
+            cur.execute("select to_regclass(%s) is not null", (partition,))
+            if cur.fetchone()[0]:
+                cur.execute("drop table {}".format(partition))
+                print("Partition '{}' of 'room' table dropped".format(partition))
+        # Delete the listings from the room table (with a partitioned room
+        # table, any that are in room_default)
         sql = """
         delete from room where survey_id = %s
         """
         cur.execute(sql, (survey_id,))
         print("{} listings deleted from 'room' table".format(cur.rowcount))
+        if config.DB_INGEST == "copy":
+            sql = """
+            delete from room_staging where survey_id = %s
+            """
+            cur.execute(sql, (survey_id,))
 
         # Delete the entry from the progress log table
         sql = """
@@ -274,13 +290,11 @@ def db_get_room_to_fill(config, survey_id):
             return listing
         except TypeError:
             logging.info("Finishing: no unfilled rooms in database --")
-            conn.rollback()
-            del config.connection
+            config.reset_connection()
             return None
         except Exception:
             logging.exception("Error retrieving room to fill from db")
-            conn.rollback()
-            del config.connection
+            config.reset_connection()
     return None
 
 
@@ -360,12 +374,8 @@ def fill_loop_by_room(config, survey_id):
     room_count = 0
     while room_count < config.FILL_MAX_ROOM_COUNT:
         try:
-            if not config.HTTP_PROXY_LIST:
-                logging.info(
-                    "No proxies left: re-initialize after %s seconds",
-                    config.RE_INIT_SLEEP_TIME)
-                time.sleep(config.RE_INIT_SLEEP_TIME)  # be nice
-                config = ABConfig()
+            # Blocked proxies are quarantined and returned by airbnb_ws,
+            # so there is no need to stop and re-read the configuration
             room_count += 1
             listing = db_get_room_to_fill(config, survey_id)
             if listing is None:
@@ -420,6 +430,11 @@ def parse_args():
                        metavar='survey_id', type=int,
                        help="""delete a survey from the database, with its
                        listings""")
+    group.add_argument('-ir', '--import_rooms',
+                       metavar='file',
+                       help="""load room rows from a CSV file with a header
+                       (such as an archived survey, optionally gzipped) into
+                       the room table, using COPY""")
     group.add_argument('-f', '--fill', nargs='?',
                        metavar='survey_id', type=int, const=0,
                        help='fill details for rooms collected with -s')
@@ -473,6 +488,19 @@ def parse_args():
                        help="""search for rooms using survey survey_id,
                        by bounding box
                        """)
+    group.add_argument('-sba', '--search_by_bounding_box_async',
+                       metavar='survey_id', type=int,
+                       help="""search for rooms using survey survey_id,
+                       by bounding box, with several requests in flight
+                       at once (see async_concurrency in example.config)
+                       """)
+    group.add_argument('-sbw', '--search_by_bounding_box_worker',
+                       metavar='survey_id', type=int,
+                       help="""join a bounding box search for survey_id as one
+                       of several workers, which may run on different
+                       machines with their own proxies and share the
+                       survey through the database
+                       """)
     group.add_argument('-asb', '--add_and_search_by_bounding_box',
                        metavar='search_area', type=str,
                        help="""add a survey for search_area and search ,
@@ -512,6 +540,14 @@ def main():
         elif args.search_by_bounding_box:
             survey = ABSurveyByBoundingBox(ab_config, args.search_by_bounding_box)
             survey.search(ab_config.FLAGS_ADD)
+        elif args.search_by_bounding_box_async:
+            survey = ABSurveyByBoundingBoxAsync(ab_config,
+                                                args.search_by_bounding_box_async)
+            survey.search(ab_config.FLAGS_ADD)
+        elif args.search_by_bounding_box_worker:
+            survey = ABSurveyByBoundingBox(ab_config,
+                                           args.search_by_bounding_box_worker)
+            survey.search_as_worker(ab_config.FLAGS_ADD)
         elif args.add_and_search_by_bounding_box:
             survey_id = db_add_survey(ab_config,
                                       args.add_and_search_by_bounding_box)
@@ -519,6 +555,8 @@ def main():
             survey.search(ab_config.FLAGS_ADD)
         elif args.fill is not None:
             fill_loop_by_room(ab_config, args.fill)
+        elif args.import_rooms:
+            import_room_dump(ab_config, args.import_rooms)
         elif args.addsearcharea:
             db_add_search_area(ab_config, args.addsearcharea, ab_config.FLAGS_ADD)
         elif args.add_survey:
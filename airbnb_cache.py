@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""
+An on-disk cache of web pages retrieved from the Airbnb web site, so that
+pages already downloaded (for example, by a survey that was interrupted,
+or before a parser fix) are read locally instead of being requested again.
+
+Each page is stored gzip-compressed under a key that is a hash of the URL
+and the query parameters, leaving out parameters such as session ids
+that change from run to run without changing the page, and of a scope:
+a survey's pages are only read back by the same survey (when it is
+resumed or re-run), never by a new survey of the same area. Entries
+expire a time-to-live after they were written (the file's mtime), and
+the least recently read entries (by atime, which get sets) are removed
+when the cache grows beyond its size limit.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from airbnb_ws import ABResponse
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+# Query parameters that identify a session rather than the page requested
+IGNORED_PARAMS = ("client_session_id", "federated_search_session_id", "key")
+
+CACHE_FILE_SUFFIX = ".gz"
+
+
+def cache_key(url, params=None, scope=None):
+    """
+    Return the cache key for a request: a hash of the scope (if any), the
+    URL and the query parameters, sorted and with session ids removed.
+    """
+    key = hashlib.sha256()
+    if scope is not None:
+        key.update(str(scope).encode("utf-8"))
+        key.update(b"\0")
+    key.update(url.encode("utf-8"))
+    if params:
+        for name in sorted(params):
+            if name in IGNORED_PARAMS or params[name] is None:
+                continue
+            key.update(b"\0")
+            key.update(str(name).encode("utf-8"))
+            key.update(b"=")
+            key.update(str(params[name]).encode("utf-8"))
+    return key.hexdigest()
+
+
+class ABResponseCache():
+    """
+    The cache lives in cache_dir, with one file per page in
+    subdirectories named by the first two characters of the key.
+    ttl is in seconds and max_size in bytes (of compressed data).
+    """
+
+    def __init__(self, cache_dir, ttl, max_size):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = sum(entry[1] for entry in self._entries())
+        LOGGER.info("Response cache at %s holds %.1f MB",
+                    self.cache_dir, self._size / 1e6)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_FILE_SUFFIX)
+
+    def _entries(self):
+        """ Yield (path, size, mtime, atime) for each file in the cache """
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(CACHE_FILE_SUFFIX):
+                    stat = entry.stat()
+                    yield (entry.path, stat.st_size, stat.st_mtime,
+                           stat.st_atime)
+
+    def _remove(self, path, size):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def get(self, url, params=None, scope=None):
+        """
+        Return a cached ABResponse for this request, or None if the page is
+        not in the cache or has expired.
+        """
+        path = self._path(cache_key(url, params, scope))
+        try:
+            stat = os.stat(path)
+            if self.ttl > 0 and time.time() - stat.st_mtime > self.ttl:
+                LOGGER.debug("Cached page has expired: %s", path)
+                self._remove(path, stat.st_size)
+                raise FileNotFoundError(path)
+            with gzip.open(path, "rb") as cache_file:
+                content = cache_file.read()
+            # record the use in atime, so eviction removes the least
+            # recently used pages; mtime stays the time it was written
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (FileNotFoundError, OSError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        LOGGER.debug("Page read from cache: %s", url)
+        return ABResponse(200, content, "utf-8", url)
+
+    def put(self, url, params, response, scope=None):
+        """ Store the body of a successful response """
+        path = self._path(cache_key(url, params, scope))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file and rename it, so that a reader never
+        # sees a partly written page
+        (handle, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                with gzip.GzipFile(fileobj=temp_file, mode="wb") as gzip_file:
+                    gzip_file.write(response.content)
+            size = os.path.getsize(temp_path)
+            try:
+                old_size = os.path.getsize(path)
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(temp_path, path)
+        except OSError:
+            LOGGER.exception("Failed to write page to cache")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        with self._lock:
+            self._size += size - old_size
+            over_limit = self.max_size > 0 and self._size > self.max_size
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove expired pages, then the least recently used ones, until the
+        cache is at most 90% of its size limit.
+        """
+        now = time.time()
+        # expired pages first, then by time of last use
+        entries = sorted(self._entries(), key=lambda entry: (
+            not (self.ttl > 0 and now - entry[2] > self.ttl), entry[3]))
+        target = 0.9 * self.max_size
+        removed = 0
+        for (path, size, mtime, atime) in entries:
+            expired = self.ttl > 0 and now - mtime > self.ttl
+            if not expired and self._size <= target:
+                break
+            self._remove(path, size)
+            removed += 1
+        LOGGER.info("Response cache: removed %s pages, %.1f MB remain",
+                    removed, self._size / 1e6)
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+"""
+Decoding of the JSON documents returned by the Airbnb web site.
+
+Documents are decoded straight from the response bytes, with the fastest
+JSON package that is installed: orjson, then ujson, then the standard
+library json module (BACKEND says which is in use). For search pages
+only the "listings" lists are wanted, and most of an explore_tabs
+document is experiences and guidebooks, so decoded documents are
+searched along the explore_tabs -> sections -> listings path rather than
+as a whole. codec_benchmark.py times this on recorded pages.
+
+Search pages used to be scanned as text instead, raw_decode-ing only the
+array after each "listings" key, to avoid decoding the whole document.
+Decoding the whole document and walking it benchmarked faster than that
+scan, so the scan was dropped.
+"""
+import itertools
+import json
+import logging
+
+try:
+    import orjson
+    BACKEND = "orjson"
+except ImportError:
+    orjson = None
+    try:
+        import ujson
+        BACKEND = "ujson"
+    except ImportError:
+        ujson = None
+        BACKEND = "json"
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+# Where the explore_tabs list is in a search page document: at the top of
+# an API response, and inside the bootstrap data of a web page
+EXPLORE_TABS_PATHS = (
+    ("explore_tabs",),
+    ("bootstrapData", "reduxData", "exploreTab", "response", "explore_tabs"),
+)
+
+# Counts the search documents whose layout was not recognized (next()
+# is atomic, so searches on several threads can share it)
+_layout_fallbacks = itertools.count(1)
+
+
+def loads(content):
+    """
+    Decode a JSON document from bytes (or str).
+    """
+    if BACKEND == "orjson":
+        if isinstance(content, str):
+            # orjson does not take str subclasses, such as the strings
+            # lxml returns for attributes
+            content = str(content)
+        return orjson.loads(content)
+    if BACKEND == "ujson":
+        return ujson.loads(content)
+    return json.loads(content)
+
+
+def find_json_keys(key, json_doc):
+    """ Return a list of the values for each occurrence of key
+    in json_doc, at all levels. In particular, "listings"
+    occurs more than once, and we need to get them all."""
+    # https://stackoverflow.com/questions/14048948/how-to-find-a-particular-json-value-by-key
+    found = []
+    if isinstance(json_doc, dict):
+        if key in json_doc.keys():
+            found.append(json_doc[key])
+        elif json_doc.keys():
+            for json_key in json_doc.keys():
+                result_list = find_json_keys(key, json_doc[json_key])
+                if result_list:
+                    found.extend(result_list)
+    elif isinstance(json_doc, list):
+        for item in json_doc:
+            result_list = find_json_keys(key, item)
+            if result_list:
+                found.extend(result_list)
+    return found
+
+
+def listings_from_search_doc(json_doc):
+    """
+    Return the "listings" lists in a decoded search page document, from
+    explore_tabs -> sections -> listings. Only that path is followed: the
+    experiences, guidebooks and metadata in the rest of the document are
+    not searched. If the document does not have that layout (the site has
+    changed), every "listings" key in it is collected instead, and the
+    fallback is logged.
+    """
+    explore_tabs = None
+    for path in EXPLORE_TABS_PATHS:
+        node = json_doc
+        for key in path:
+            if not isinstance(node, dict):
+                node = None
+                break
+            node = node.get(key)
+        if isinstance(node, list):
+            explore_tabs = node
+            break
+    if explore_tabs is not None:
+        listings_lists = []
+        has_sections = False
+        for tab in explore_tabs:
+            if not isinstance(tab, dict) or not isinstance(tab.get("sections"), list):
+                continue
+            has_sections = True
+            for section in tab["sections"]:
+                if isinstance(section, dict) and "listings" in section:
+                    listings_lists.append(section["listings"])
+        if has_sections:
+            return listings_lists
+    fallbacks = next(_layout_fallbacks)
+    if fallbacks == 1 or fallbacks % 100 == 0:
+        LOGGER.warning("Search page layout not recognized (%s pages so far): "
+                       "searching the whole document for listings. "
+                       "Has the site changed?", fallbacks)
+    return find_json_keys("listings", json_doc)
+
+
+def listings_from_search_json(content):
+    """
+    Return the "listings" lists in a search page JSON document (bytes):
+    a list of lists of {listing, pricing_quote, ...} dicts.
+    """
+    return listings_from_search_doc(loads(content))
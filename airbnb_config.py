@@ -2,15 +2,21 @@
 # ============================================================================
 # Airbnb Configuration module, for use in web scraping and analytics
 # ============================================================================
+import contextlib
 import logging
 import os
 import configparser
 import sys
+import threading
 import psycopg2
 import psycopg2.errorcodes
+import psycopg2.pool
 
 logger = logging.getLogger()
 
+# Seconds to wait for a connection when all db_pool_max are checked out
+POOL_CHECKOUT_TIMEOUT = 60
+
 class ABConfig():
 
     def __init__(self, args=None):
@@ -27,7 +33,17 @@ class ABConfig():
                     self.log_level = logging.INFO
             except:
                 self.log_level = logging.INFO
-        self.connection = None
+        # the connection pool is made at the first connect(); _connections
+        # holds the connection checked out by each thread, by thread ident
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._pool_slots = None
+        self._connections = {}
+        self.DB_POOL_MIN = 1
+        self.DB_POOL_MAX = 10
+        self.DB_BATCH_SIZE = 100
+        self.DB_INGEST = "insert"
+        self.DB_WRITER_QUEUE_SIZE = 0
         self.FLAGS_ADD = 1
         self.FLAGS_PRINT = 9
         self.FLAGS_INSERT_REPLACE = True
@@ -46,8 +62,36 @@ class ABConfig():
         self.SEARCH_LISTINGS_ON_FULL_PAGE = 18
         self.SEARCH_DO_LOOP_OVER_PRICES = False
         self.SEARCH_DO_LOOP_OVER_ROOM_TYPES = False
+        self.SEARCH_WORKERS = 1
+        self.FRONTIER_CLAIM_TIMEOUT = 600.0
+        self.SEARCH_WARM_START = False
+        self.SEARCH_SPLIT_STRATEGY = "midpoint"
+        self.SEARCH_PREFETCH_PAGES = 0
         self.HTTP_PROXY_LIST = []
         self.HTTP_PROXY_LIST_COMPLETE = []
+        self.HTTP_POOL_MAXSIZE = 4
+        self.HTTP_SESSION_MAX_REQUESTS = 1000
+        self.ASYNC_CONCURRENCY = 8
+        self.RATE_INITIAL = 1.0
+        self.RATE_MIN = 0.05
+        self.RATE_MAX = 5.0
+        self.RATE_INCREASE = 0.1
+        self.RATE_DECREASE = 0.5
+        self.PROXY_QUARANTINE_MAX = 3600.0
+        self.CACHE_DIR = None
+        self.CACHE_TTL = 7 * 24 * 3600.0
+        self.CACHE_MAX_SIZE = 1024 * 1000000
+        # not read from the file: set by a survey, so that cached pages are
+        # only read back by the same survey
+        self.CACHE_SCOPE = None
+        self.RECORD_DIR = None
+        self.METRICS_FILE = None
+        self.METRICS_FORMAT = "prometheus"
+        self.METRICS_INTERVAL = 30.0
+        self.HEDGE_RATE = 0.05
+        self.REQUEST_DEADLINE = 0.0
+        self.RETRY_BUDGET_RATIO = 0.2
+        self.RETRY_BUDGET_MAX = 100.0
         self.GOOGLE_API_KEY = None
 
         try:
@@ -77,6 +121,25 @@ class ABConfig():
                 logger.error("Incomplete database information in %s: cannot continue",
                              self.config_file)
                 sys.exit()
+            self.DB_POOL_MIN = config["DATABASE"].getint("db_pool_min",
+                                                         self.DB_POOL_MIN)
+            self.DB_POOL_MAX = config["DATABASE"].getint("db_pool_max",
+                                                         self.DB_POOL_MAX)
+            if self.DB_POOL_MAX < max(1, self.DB_POOL_MIN):
+                logger.warning("db_pool_max %s is less than db_pool_min %s: "
+                               "using %s", self.DB_POOL_MAX, self.DB_POOL_MIN,
+                               max(1, self.DB_POOL_MIN))
+                self.DB_POOL_MAX = max(1, self.DB_POOL_MIN)
+            self.DB_BATCH_SIZE = config["DATABASE"].getint("db_batch_size",
+                                                           self.DB_BATCH_SIZE)
+            self.DB_WRITER_QUEUE_SIZE = config["DATABASE"].getint(
+                "db_writer_queue_size", self.DB_WRITER_QUEUE_SIZE)
+            self.DB_INGEST = config["DATABASE"].get(
+                "db_ingest", self.DB_INGEST).strip().lower()
+            if self.DB_INGEST not in ("insert", "copy"):
+                logger.warning("Unknown db_ingest %s: using insert",
+                               self.DB_INGEST)
+                self.DB_INGEST = "insert"
             # network
             try:
                 self.HTTP_PROXY_LIST = config["NETWORK"]["proxy_list"].split(",")
@@ -102,6 +165,44 @@ class ABConfig():
                 int(config["NETWORK"]["max_connection_attempts"])
             self.REQUEST_SLEEP = float(config["NETWORK"]["request_sleep"])
             self.HTTP_TIMEOUT = float(config["NETWORK"]["http_timeout"])
+            network = config["NETWORK"]
+            self.HTTP_POOL_MAXSIZE = network.getint("http_pool_maxsize",
+                                                    self.HTTP_POOL_MAXSIZE)
+            self.HTTP_SESSION_MAX_REQUESTS = network.getint(
+                "http_session_max_requests", self.HTTP_SESSION_MAX_REQUESTS)
+            self.ASYNC_CONCURRENCY = network.getint("async_concurrency",
+                                                    self.ASYNC_CONCURRENCY)
+            # per-proxy request rates (requests per second): any that are
+            # missing from the config file keep their defaults
+            self.RATE_INITIAL = network.getfloat("rate_initial", self.RATE_INITIAL)
+            self.RATE_MIN = network.getfloat("rate_min", self.RATE_MIN)
+            self.RATE_MAX = network.getfloat("rate_max", self.RATE_MAX)
+            self.RATE_INCREASE = network.getfloat("rate_increase", self.RATE_INCREASE)
+            self.RATE_DECREASE = network.getfloat("rate_decrease", self.RATE_DECREASE)
+            self.PROXY_QUARANTINE_MAX = network.getfloat(
+                "proxy_quarantine_max", self.PROXY_QUARANTINE_MAX)
+            # optional on-disk cache of pages: max size is in megabytes
+            self.CACHE_DIR = network.get("cache_dir", self.CACHE_DIR) or None
+            self.CACHE_TTL = network.getfloat("cache_ttl", self.CACHE_TTL)
+            self.CACHE_MAX_SIZE = int(network.getfloat(
+                "cache_max_size", self.CACHE_MAX_SIZE / 1e6) * 1e6)
+            # record pages for airbnb_replay.py, and (to replay them) where
+            # room pages are found
+            self.RECORD_DIR = network.get("record_dir", self.RECORD_DIR) or None
+            self.URL_ROOM_ROOT = network.get("url_room_root", self.URL_ROOM_ROOT)
+            # request metrics snapshot: prometheus or json
+            self.METRICS_FILE = network.get("metrics_file", self.METRICS_FILE) or None
+            self.METRICS_FORMAT = network.get("metrics_format", self.METRICS_FORMAT)
+            self.METRICS_INTERVAL = network.getfloat("metrics_interval",
+                                                     self.METRICS_INTERVAL)
+            self.HEDGE_RATE = network.getfloat("hedge_rate", self.HEDGE_RATE)
+            # deadline (seconds) for each page, across its attempts; 0 for none
+            self.REQUEST_DEADLINE = network.getfloat("request_deadline",
+                                                     self.REQUEST_DEADLINE)
+            self.RETRY_BUDGET_RATIO = network.getfloat("retry_budget_ratio",
+                                                       self.RETRY_BUDGET_RATIO)
+            self.RETRY_BUDGET_MAX = network.getfloat("retry_budget_max",
+                                                     self.RETRY_BUDGET_MAX)
             try:
                 self.URL_API_SEARCH_ROOT = config["NETWORK"]["url_api_search_root"]
             except: 
@@ -152,6 +253,21 @@ class ABConfig():
                 logger.warning(
                     "Missing config file entry: search_rectangle_edge_blur.")
                 logger.warning("For more information, see example.config")
+            survey = config["SURVEY"]
+            self.SEARCH_WORKERS = survey.getint("search_workers",
+                                                self.SEARCH_WORKERS)
+            self.FRONTIER_CLAIM_TIMEOUT = survey.getfloat(
+                "frontier_claim_timeout", self.FRONTIER_CLAIM_TIMEOUT)
+            self.SEARCH_WARM_START = survey.getint(
+                "search_warm_start", int(self.SEARCH_WARM_START)) == 1
+            self.SEARCH_SPLIT_STRATEGY = survey.get(
+                "search_split_strategy", self.SEARCH_SPLIT_STRATEGY).strip().lower()
+            if self.SEARCH_SPLIT_STRATEGY not in ("midpoint", "median", "kd"):
+                logger.warning("Unknown search_split_strategy %s: using midpoint",
+                               self.SEARCH_SPLIT_STRATEGY)
+                self.SEARCH_SPLIT_STRATEGY = "midpoint"
+            self.SEARCH_PREFETCH_PAGES = survey.getint("search_prefetch_pages",
+                                                       self.SEARCH_PREFETCH_PAGES)
 
             # account
             try:
@@ -167,25 +283,128 @@ class ABConfig():
             raise
 
     def connect(self):
-    # get a database connection
-        """ Return a connection to the database"""
+        """
+        Return this thread's connection to the database. The first call on
+        a thread checks a connection out of the pool, and later calls
+        return the same one, until reset_connection or release_connection.
+        Threads can use the database at the same time, each with its own
+        connection.
+        """
+        ident = threading.get_ident()
+        conn = self._connections.get(ident)
+        if conn is not None and conn.closed == 0:
+            return conn
+        if conn is not None:
+            self.reset_connection()
+        conn = self.checkout_connection()
+        self._connections[ident] = conn
+        return conn
+
+    def reset_connection(self):
+        """
+        Discard this thread's connection (after an error that may have
+        broken it): the next connect() checks out a fresh one.
+        """
+        conn = self._connections.pop(threading.get_ident(), None)
+        if conn is not None:
+            self.return_connection(conn, close=True)
+
+    def release_connection(self):
+        """ Return this thread's connection to the pool, for other threads """
+        conn = self._connections.pop(threading.get_ident(), None)
+        if conn is not None:
+            self.return_connection(conn)
+
+    @contextlib.contextmanager
+    def pooled_connection(self):
+        """
+        A connection checked out of the pool for a with block, separate
+        from the thread's connect() connection. It is committed at the end
+        of the block, or rolled back if the block raises, and returned.
+        """
+        conn = self.checkout_connection()
         try:
-            if (not hasattr(self, "connection") or
-                    self.connection is None or
-                    self.connection.closed != 0):
-                cattr = dict(
-                    user=self.DB_USER,
-                    password=self.DB_PASSWORD,
-                    database=self.DB_NAME
-                )
-                if self.DB_HOST is not None:
-                    cattr.update(dict(
-                        host=self.DB_HOST,
-                        port=self.DB_PORT,
-                    ))
-                self.connection = psycopg2.connect(**cattr)
-                self.connection.set_client_encoding('UTF8')
-            return self.connection
+            yield conn
+            conn.commit()
+        except Exception:
+            if conn.closed == 0:
+                conn.rollback()
+            raise
+        finally:
+            self.return_connection(conn, close=(conn.closed != 0))
+
+    def checkout_connection(self):
+        """
+        Take a connection from the pool, making the pool if need be, and
+        waiting up to POOL_CHECKOUT_TIMEOUT seconds if all db_pool_max are
+        checked out. Connections are health-checked: a closed or broken
+        one is discarded and another is taken.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = self._make_pool()
+                self._pool_slots = threading.BoundedSemaphore(self.DB_POOL_MAX)
+            self._reclaim_connections()
+        if not self._pool_slots.acquire(timeout=POOL_CHECKOUT_TIMEOUT):
+            raise psycopg2.pool.PoolError(
+                "all {} database connections are in use: "
+                "increase db_pool_max".format(self.DB_POOL_MAX))
+        try:
+            # each attempt after the first is with a new connection, as
+            # the broken ones are closed
+            for _ in range(self.DB_POOL_MAX + 1):
+                conn = self._pool.getconn()
+                if self._connection_ok(conn):
+                    return conn
+                logger.warning("Discarding a broken database connection")
+                self._pool.putconn(conn, close=True)
+            raise psycopg2.OperationalError("No working database connection")
+        except Exception:
+            self._pool_slots.release()
+            raise
+
+    def return_connection(self, conn, close=False):
+        """ Put a connection back in the pool (or close it) """
+        if self._pool is None:
+            # the pool has been closed
+            conn.close()
+            return
+        try:
+            if not close and conn.closed == 0:
+                # do not hand out a connection in the middle of a transaction
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        try:
+            self._pool.putconn(conn, close=close)
+        except psycopg2.pool.PoolError:
+            logger.warning("Database connection was not from the pool")
+            return
+        self._pool_slots.release()
+
+    def close_pool(self):
+        """ Close every connection in the pool """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._connections = {}
+
+    def _make_pool(self):
+        # call with _pool_lock held
+        cattr = dict(
+            user=self.DB_USER,
+            password=self.DB_PASSWORD,
+            database=self.DB_NAME
+        )
+        if self.DB_HOST is not None:
+            cattr.update(dict(
+                host=self.DB_HOST,
+                port=self.DB_PORT,
+            ))
+        try:
+            return psycopg2.pool.ThreadedConnectionPool(
+                self.DB_POOL_MIN, self.DB_POOL_MAX, **cattr)
         except psycopg2.OperationalError as pgoe:
             logger.error(pgoe.pgerror)
             raise
@@ -193,3 +412,28 @@ class ABConfig():
             logger.error("Failed to connect to database.")
             raise
 
+    def _reclaim_connections(self):
+        # call with _pool_lock held: return the connections of threads
+        # that have finished (such as the workers of a finished executor)
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in list(self._connections):
+            if ident not in alive:
+                conn = self._connections.pop(ident, None)
+                if conn is not None:
+                    self.return_connection(conn, close=(conn.closed != 0))
+
+    @staticmethod
+    def _connection_ok(conn):
+        """ True if a connection is open and answers a query """
+        if conn.closed != 0:
+            return False
+        try:
+            conn.set_client_encoding('UTF8')
+            cur = conn.cursor()
+            cur.execute("select 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
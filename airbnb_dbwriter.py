@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+"""
+A background thread that does a survey's database writes, so that search
+pages are fetched while the listings from earlier pages are written,
+rather than the two taking turns.
+
+Listings and progress events (frontier checkpoints and the like, given
+as a function and its arguments) go into a bounded queue, and are written
+in the order they were queued, so progress is never recorded ahead of
+the listings it covers. When the queue is full, putting into it waits
+(the fetch loop slows to the pace of the database). Listings are
+written in batches with ABListingWriter: when the database falls behind,
+the batches grow to db_batch_size. The queue depth is reported in the
+request metrics, as the db_writer_queue_depth gauge.
+"""
+import copy
+import logging
+import queue
+import signal
+import threading
+import time
+import airbnb_ws
+from airbnb_listing import ABListingWriter
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+# Seconds between reports of the queue depth
+REPORT_INTERVAL = 60
+
+# Put into the queue to stop the thread
+_STOP = object()
+
+
+class ABDatabaseWriter():
+    """
+    Write listings and progress events from a bounded queue, on a thread
+    of its own (with its own database connection).
+    """
+
+    def __init__(self, config, queue_size=None):
+        self.config = config
+        if queue_size is None:
+            queue_size = config.DB_WRITER_QUEUE_SIZE
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.metrics = airbnb_ws.get_metrics(config)
+        self._thread = None
+        self._previous_sigterm = None
+        self.error = None
+        self.listings_written = 0
+        self.new_rooms = 0
+        self.failed = 0
+        self._last_report = time.monotonic()
+        self._last_full_warning = 0
+
+    def start(self):
+        """
+        Start the writer thread. On the main thread, SIGTERM is turned into
+        SystemExit while the writer runs, so that a survey that is stopped
+        still flushes the queue as it unwinds (see close).
+        """
+        self._thread = threading.Thread(target=self._run, name="dbwriter",
+                                        daemon=True)
+        self._thread.start()
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigterm = signal.signal(signal.SIGTERM,
+                                                   _exit_on_sigterm)
+        LOGGER.info("Database writer started, queue size %s",
+                    self._queue.maxsize)
+
+    def depth(self):
+        """ The number of items waiting to be written """
+        return self._queue.qsize()
+
+    def put_listing(self, listing):
+        """ Queue a listing to be inserted, waiting if the queue is full """
+        self._put(listing)
+
+    def put_event(self, function, *args):
+        """
+        Queue a call of function(*args), made after the items already
+        queued are written. The arguments are copied, as the caller may go
+        on changing them (frontier nodes are updated page by page).
+        """
+        self._put((function, copy.deepcopy(args)))
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            now = time.monotonic()
+            if now - self._last_full_warning > REPORT_INTERVAL:
+                self._last_full_warning = now
+                LOGGER.info("Database writer queue is full (%s items): "
+                            "searching waits for the database",
+                            self._queue.maxsize)
+            self._queue.put(item)
+        self._gauge()
+
+    def close(self):
+        """
+        Write everything queued, stop the thread and restore the SIGTERM
+        handler. Re-raises any error the writer stopped on.
+        """
+        if self._thread is None:
+            return
+        LOGGER.info("Database writer: flushing %s queued items", self.depth())
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        if self._previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self._previous_sigterm)
+            self._previous_sigterm = None
+        LOGGER.info("Database writer: %s listings written, %s new, %s failed",
+                    self.listings_written, self.new_rooms, self.failed)
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        writer = ABListingWriter(self.config)
+        stopping = False
+        try:
+            while not stopping:
+                # write whatever has been queued: a few items when the
+                # database keeps up, larger batches when it does not
+                items = [self._queue.get()]
+                while True:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for item in items:
+                    if item is _STOP:
+                        stopping = True
+                    elif isinstance(item, tuple):
+                        self._write(writer, writer.flush())
+                        (function, args) = item
+                        function(*args)
+                    else:
+                        self._write(writer, writer.add(item), 1)
+                self._write(writer, writer.flush())
+                self._gauge()
+                self._report()
+        except Exception as ex:
+            LOGGER.exception("Database writer failed: stopping the survey")
+            self.error = ex
+            # keep draining so that callers see the error instead of waiting
+            stopping = any(item is _STOP for item in items)
+            while not stopping:
+                stopping = self._queue.get() is _STOP
+        finally:
+            self.config.release_connection()
+
+    def _write(self, writer, inserted, queued=0):
+        # account for the result of writer.add or writer.flush
+        self.listings_written += queued
+        self.new_rooms += len(inserted)
+        if writer.failed:
+            self.failed += len(writer.failed)
+            LOGGER.warning("Database writer: listings %s not saved", writer.failed)
+            writer.failed = []
+
+    def _gauge(self):
+        self.metrics.gauge("db_writer_queue_depth", self.depth())
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._last_report > REPORT_INTERVAL:
+            self._last_report = now
+            LOGGER.info("Database writer: %s items queued, %s listings written",
+                        self.depth(), self.listings_written)
+
+
+def _exit_on_sigterm(signum, frame):
+    raise SystemExit("Terminated (SIGTERM)")
@@ -4,15 +4,38 @@
 #
 # An ABListing represents and individual Airbnb listing
 # ============================================================================
+import gzip
+import io
 import logging
 import re
 from lxml import html
 import psycopg2
-import json
+import psycopg2.extras
+import airbnb_codec
 import airbnb_ws
 
 logger = logging.getLogger()
 
+# The columns of the room table written by an insert, in the order of
+# ABListing.insert_args
+ROOM_INSERT_COLUMNS = (
+    "room_id", "host_id", "room_type", "country", "city",
+    "neighborhood", "address", "reviews", "overall_satisfaction",
+    "accommodates", "bedrooms", "bathrooms", "price", "deleted",
+    "minstay", "latitude", "longitude", "survey_id",
+    "coworker_hosted", "extra_host_languages", "name",
+    "property_type", "currency", "rate_type",
+)
+
+# With db_ingest = copy, listings are copied into this UNLOGGED table
+# (which has the ROOM_INSERT_COLUMNS and last_modified) and moved into
+# room by merge_staged_listings
+ROOM_STAGING_TABLE = "room_staging"
+
+# Once schema_update.py has partitioned room by survey_id, each survey's
+# listings are in a partition of this name (and any others in room_default)
+ROOM_PARTITION = "room_survey_{}"
+
 
 class ABListing():
     """
@@ -144,22 +167,21 @@ class ABListing():
         except psycopg2.OperationalError:
             # connection closed
             logger.error("Operational error (connection closed): resuming")
-            del(self.config.connection)
+            self.config.reset_connection()
         except psycopg2.DatabaseError as de:
-            self.config.connection.conn.rollback()
-            logger.erro(psycopg2.errorcodes.lookup(de.pgcode[:2]))
+            logger.error(psycopg2.errorcodes.lookup(de.pgcode[:2]))
             logger.error("Database error: resuming")
-            del(self.config.connection)
+            self.config.reset_connection()
         except psycopg2.InterfaceError:
             # connection closed
             logger.error("Interface error: resuming")
-            del(self.config.connection)
+            self.config.reset_connection()
         except psycopg2.Error as pge:
-            # database error: rollback operations and resume
-            self.config.connection.conn.rollback()
+            # database error: discard the connection (and its transaction)
+            # and resume
             logger.error("Database error: " + str(self.room_id))
             logger.error("Diagnostics " + pge.diag.message_primary)
-            del(self.config.connection)
+            self.config.reset_connection()
         except (KeyboardInterrupt, SystemExit):
             raise
         except UnicodeEncodeError as uee:
@@ -172,7 +194,7 @@ class ABListing():
             logger.error("AttributeError")
             raise
         except Exception:
-            self.config.connection.rollback()
+            self.config.connect().rollback()
             logger.error("Exception saving room")
             raise
 
@@ -261,6 +283,18 @@ class ABListing():
             logger.error("Exception: " + str(type(ex)))
             raise
 
+    def insert_args(self):
+        """ The values for ROOM_INSERT_COLUMNS """
+        return (
+            self.room_id, self.host_id, self.room_type, self.country,
+            self.city, self.neighborhood, self.address, self.reviews,
+            self.overall_satisfaction, self.accommodates, self.bedrooms,
+            self.bathrooms, self.price, self.deleted, self.minstay,
+            self.latitude, self.longitude, self.survey_id,
+            self.coworker_hosted, self.extra_host_languages, self.name,
+            self.property_type, self.currency, self.rate_type
+            )
+
     def __insert(self):
         """ Insert a room into the database. Raise an error if it fails """
         try:
@@ -269,31 +303,10 @@ class ABListing():
             logger.debug("\thost_id: {}".format(self.host_id))
             conn = self.config.connect()
             cur = conn.cursor()
-            sql = """
-                insert into room (
-                    room_id, host_id, room_type, country, city,
-                    neighborhood, address, reviews, overall_satisfaction,
-                    accommodates, bedrooms, bathrooms, price, deleted,
-                    minstay, latitude, longitude, survey_id,
-                    coworker_hosted, extra_host_languages, name,
-                    property_type, currency, rate_type
-
-                )
-                """
-            sql += """
-                values (%s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s
-                )"""
-            insert_args = (
-                self.room_id, self.host_id, self.room_type, self.country,
-                self.city, self.neighborhood, self.address, self.reviews,
-                self.overall_satisfaction, self.accommodates, self.bedrooms,
-                self.bathrooms, self.price, self.deleted, self.minstay,
-                self.latitude, self.longitude, self.survey_id,
-                self.coworker_hosted, self.extra_host_languages, self.name,
-                self.property_type, self.currency, self.rate_type
-                )
+            sql = "insert into room ({}) values ({})".format(
+                ", ".join(ROOM_INSERT_COLUMNS),
+                ", ".join(["%s"] * len(ROOM_INSERT_COLUMNS)))
+            insert_args = self.insert_args()
             cur.execute(sql, insert_args)
             cur.close()
             conn.commit()
@@ -377,17 +390,25 @@ class ABListing():
         except:
             raise
 
-    def __get_rating(self, tree):
+    def __get_bootstrap_listing(self, tree):
+        """
+        Return the json in the _bootstrap-listing meta tag (2016-04-10),
+        decoded once for all the items read from it, or None if the page
+        does not have one.
+        """
+        s = tree.xpath("//meta[@id='_bootstrap-listing']/@content")
+        if len(s) > 0:
+            return airbnb_codec.loads(s[0])
+        return None
+
+    def __get_rating(self, tree, bootstrap):
         try:
-            # 2016-04-10
-            s = tree.xpath("//meta[@id='_bootstrap-listing']/@content")
             temp = tree.xpath(
                 "//meta[contains(@property,'airbedandbreakfast:rating')]"
                 "/@content"
                 )
-            if s is not None:
-                j = json.loads(s[0])
-                self.overall_satisfaction = j["listing"]["star_rating"]
+            if bootstrap is not None:
+                self.overall_satisfaction = bootstrap["listing"]["star_rating"]
             elif len(temp) > 0:
                 self.overall_satisfaction = temp[0]
         except IndexError:
@@ -417,18 +438,15 @@ class ABListing():
         except:
             raise
 
-    def __get_host_id(self, tree):
+    def __get_host_id(self, tree, bootstrap):
         try:
-            # 2016-04-10
-            s = tree.xpath("//meta[@id='_bootstrap-listing']/@content")
             temp = tree.xpath(
                 "//div[@id='host-profile']"
                 "//a[contains(@href,'/users/show')]"
                 "/@href"
             )
-            if s is not None:
-                j = json.loads(s[0])
-                self.host_id = j["listing"]["user"]["id"]
+            if bootstrap is not None:
+                self.host_id = bootstrap["listing"]["user"]["id"]
                 return
             elif len(temp) > 0:
                 host_id_element = temp[0]
@@ -522,21 +540,18 @@ class ABListing():
         except:
             raise
 
-    def __get_reviews(self, tree):
+    def __get_reviews(self, tree, bootstrap):
         try:
-            # 2016-04-10
-            s = tree.xpath("//meta[@id='_bootstrap-listing']/@content")
             # 2015-10-02
             temp2 = tree.xpath(
                 "//div[@class='___iso-state___p3summarybundlejs']"
                 "/@data-state"
                 )
-            if s is not None:
-                j = json.loads(s[0])
+            if bootstrap is not None:
                 self.reviews = \
-                    j["listing"]["review_details_interface"]["review_count"]
+                    bootstrap["listing"]["review_details_interface"]["review_count"]
             elif len(temp2) == 1:
-                summary = json.loads(temp2[0])
+                summary = airbnb_codec.loads(temp2[0])
                 self.reviews = summary["visibleReviewCount"]
             elif len(temp2) == 0:
                 temp = tree.xpath(
@@ -562,18 +577,15 @@ class ABListing():
             logger.exception(e)
             self.reviews = None
 
-    def __get_accommodates(self, tree):
+    def __get_accommodates(self, tree, bootstrap):
         try:
-            # 2016-04-10
-            s = tree.xpath("//meta[@id='_bootstrap-listing']/@content")
             temp = tree.xpath(
                 "//div[@class='col-md-6']"
                 "/div/span[text()[contains(.,'Accommodates:')]]"
                 "/../strong/text()"
                 )
-            if s is not None:
-                j = json.loads(s[0])
-                self.accommodates = j["listing"]["person_capacity"]
+            if bootstrap is not None:
+                self.accommodates = bootstrap["listing"]["person_capacity"]
                 return
             elif len(temp) > 0:
                 self.accommodates = temp[0].strip()
@@ -712,17 +724,19 @@ class ABListing():
             # warning.  Items coded in <meta
             # property="airbedandbreakfast:*> elements -- country --
 
+            # the json in the _bootstrap-listing meta tag is decoded once
+            bootstrap = self.__get_bootstrap_listing(tree)
             self.__get_country(tree)
             self.__get_city(tree)
-            self.__get_rating(tree)
+            self.__get_rating(tree, bootstrap)
             self.__get_latitude(tree)
             self.__get_longitude(tree)
-            self.__get_host_id(tree)
+            self.__get_host_id(tree, bootstrap)
             self.__get_room_type(tree)
             self.__get_neighborhood(tree)
             self.__get_address(tree)
-            self.__get_reviews(tree)
-            self.__get_accommodates(tree)
+            self.__get_reviews(tree, bootstrap)
+            self.__get_accommodates(tree, bootstrap)
             self.__get_bedrooms(tree)
             self.__get_bathrooms(tree)
             self.__get_minstay(tree)
@@ -757,3 +771,251 @@ class ABListing():
         except Exception:
             logger.exception("Error parsing web page.")
             raise
+
+
+class ABListingWriter():
+    """
+    Insert new listings in batches: one INSERT ... ON CONFLICT DO NOTHING
+    statement and one commit for up to batch_size listings, instead of
+    one of each per listing. Listings already in the database are
+    skipped, as ABListing.save does with FLAGS_INSERT_NO_REPLACE.
+    With db_ingest = copy, batches are copied into ROOM_STAGING_TABLE
+    instead, to be merged into room at the end of the survey.
+
+        writer = ABListingWriter(config)
+        for listing in listings:
+            inserted.extend(writer.add(listing))
+        inserted.extend(writer.flush())
+    """
+
+    def __init__(self, config, batch_size=None):
+        self.config = config
+        if batch_size is None:
+            batch_size = config.DB_BATCH_SIZE
+        self.batch_size = max(1, batch_size)
+        self.listings = []
+        # room_ids of listings that could not be written at all
+        self.failed = []
+
+    def add(self, listing):
+        """
+        Add a listing to the batch. Returns the room_ids inserted if the
+        batch was full and so was written, and an empty list otherwise.
+        """
+        self.listings.append(listing)
+        if len(self.listings) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Write the batch. Returns the room_ids of the listings that were
+        inserted, leaving out those that were already in the database.
+        If the batch insert fails, or psycopg2 is older than 2.7 (which
+        added execute_values), the listings are saved one at a time.
+        """
+        if not self.listings:
+            return []
+        (listings, self.listings) = (self.listings, [])
+        if self.config.DB_INGEST == "copy":
+            return self.copy_to_staging(listings)
+        if not hasattr(psycopg2.extras, "execute_values"):
+            return self.save_each(listings)
+        sql = """
+            insert into room ({})
+            values %s
+            on conflict do nothing
+            returning room_id
+            """.format(", ".join(ROOM_INSERT_COLUMNS))
+        conn = None
+        try:
+            conn = self.config.connect()
+            cur = conn.cursor()
+            # a single page, so that fetchall sees every inserted row
+            psycopg2.extras.execute_values(
+                cur, sql, [listing.insert_args() for listing in listings],
+                page_size=len(listings))
+            inserted = [row[0] for row in cur.fetchall()]
+            cur.close()
+            conn.commit()
+            logger.debug("Batch of %s listings: %s inserted",
+                         len(listings), len(inserted))
+            return inserted
+        except psycopg2.Error:
+            logger.exception("Batch insert of %s listings failed: "
+                             "saving them one at a time", len(listings))
+            if conn is not None:
+                conn.rollback()
+            return self.save_each(listings)
+
+    def save_each(self, listings):
+        """
+        Save listings one at a time. Returns the room_ids of those that
+        were inserted.
+        """
+        inserted = []
+        for listing in listings:
+            saved = listing.save(self.config.FLAGS_INSERT_NO_REPLACE)
+            if saved:
+                inserted.append(listing.room_id)
+            elif saved is None:
+                self.failed.append(listing.room_id)
+        return inserted
+
+    def copy_to_staging(self, listings):
+        """
+        Copy a batch into ROOM_STAGING_TABLE with COPY FROM STDIN. Returns
+        all their room_ids: whether they are new to room is only known
+        when they are merged, so the caller passes only listings it has
+        not seen before (see ABSurveyByBoundingBox.room_ids).
+        """
+        data = io.StringIO()
+        for listing in listings:
+            data.write(copy_csv_row(listing.insert_args()))
+        data.seek(0)
+        conn = None
+        try:
+            conn = self.config.connect()
+            cur = conn.cursor()
+            cur.copy_expert("copy {} ({}) from stdin with (format csv)".format(
+                ROOM_STAGING_TABLE, ", ".join(ROOM_INSERT_COLUMNS)), data)
+            cur.close()
+            conn.commit()
+            logger.debug("Batch of %s listings copied to %s",
+                         len(listings), ROOM_STAGING_TABLE)
+            return [listing.room_id for listing in listings]
+        except psycopg2.Error:
+            logger.exception("Copy of %s listings to %s failed: "
+                             "saving them one at a time",
+                             len(listings), ROOM_STAGING_TABLE)
+            if conn is not None:
+                conn.rollback()
+            return self.save_each(listings)
+
+
+def copy_csv_row(values):
+    """
+    A line of COPY ... (format csv) input: None is written as an empty
+    field (NULL), strings are always quoted (so an empty string is not
+    NULL), and lists are written as array literals.
+    """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append("")
+        elif isinstance(value, bool):
+            fields.append(str(int(value)))
+        elif isinstance(value, (int, float)):
+            fields.append(str(value))
+        else:
+            if isinstance(value, (list, tuple)):
+                value = "{" + ",".join(str(item) for item in value) + "}"
+            fields.append('"' + str(value).replace('"', '""') + '"')
+    return ",".join(fields) + "\n"
+
+
+def merge_staged_listings(config, survey_id=None):
+    """
+    Move the listings in ROOM_STAGING_TABLE for a survey (or, with no
+    survey_id, for all surveys) into room, with one set-based statement.
+    Listings already in room, or staged more than once, are merged once.
+    Returns the number of listings added to room.
+    """
+    columns = ", ".join(ROOM_INSERT_COLUMNS + ("last_modified",))
+    if survey_id is None:
+        where = ""
+        args = ()
+    else:
+        where = "where survey_id = %s"
+        args = (survey_id,)
+    sql = """
+        with staged as (
+            delete from {table} {where}
+            returning {columns}
+        )
+        insert into room ({columns})
+        select distinct on (room_id, survey_id) {columns}
+        from staged
+        order by room_id, survey_id, last_modified
+        on conflict do nothing
+        """.format(table=ROOM_STAGING_TABLE, where=where, columns=columns)
+    with config.pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, args)
+        merged = cur.rowcount
+        cur.close()
+    logger.info("Merged %s staged listings into room", merged)
+    return merged
+
+
+def room_is_partitioned(config):
+    """ True if the room table is partitioned by survey_id """
+    conn = config.connect()
+    cur = conn.cursor()
+    cur.execute("""
+        select relkind = 'p' from pg_class where oid = to_regclass('room')
+        """)
+    row = cur.fetchone()
+    cur.close()
+    conn.commit()
+    return row is not None and row[0]
+
+
+def add_room_partition(config, survey_id):
+    """
+    If room is partitioned, make sure survey_id has a partition of its
+    own before its listings are written. Returns True if it has one.
+    """
+    partition = ROOM_PARTITION.format(int(survey_id))
+    conn = config.connect()
+    try:
+        if not room_is_partitioned(config):
+            return False
+        cur = conn.cursor()
+        cur.execute("select to_regclass(%s) is not null", (partition,))
+        if not cur.fetchone()[0]:
+            cur.execute("""
+                create table if not exists {} partition of room
+                for values in (%s)
+                """.format(partition), (int(survey_id),))
+            logger.info("Partition %s of room created", partition)
+        cur.close()
+        conn.commit()
+        return True
+    except psycopg2.Error:
+        # for example, the survey already has listings in room_default
+        conn.rollback()
+        logger.warning("No partition %s of room: the listings of survey %s "
+                       "go in room_default", partition, survey_id,
+                       exc_info=True)
+        return False
+
+
+def import_room_dump(config, path):
+    """
+    Load a CSV file of room rows (such as an archived survey, saved with
+    \\copy (select ...) to 'file.csv' with (format csv, header)) into
+    room, through ROOM_STAGING_TABLE: the header names the columns, which
+    must be among ROOM_INSERT_COLUMNS and last_modified, and include
+    room_id and survey_id. A .gz file is decompressed as it is read.
+    Rows already in room are left as they are.
+    """
+    allowed = ROOM_INSERT_COLUMNS + ("last_modified",)
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as dump:
+        header = dump.readline().strip()
+        columns = [column.strip().strip('"').lower()
+                   for column in header.split(",")]
+        unknown = [column for column in columns if column not in allowed]
+        if unknown or "room_id" not in columns or "survey_id" not in columns:
+            logger.error("%s: the header must name room columns, including "
+                         "room_id and survey_id (unknown: %s)",
+                         path, ", ".join(unknown) or "none")
+            return 0
+        with config.pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.copy_expert("copy {} ({}) from stdin with (format csv)".format(
+                ROOM_STAGING_TABLE, ", ".join(columns)), dump)
+            logger.info("Copied %s rows from %s", cur.rowcount, path)
+            cur.close()
+    return merge_staged_listings(config)
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+"""
+Request-level metrics for the web requests made by airbnb_ws: latency
+histograms, status codes, bytes transferred, retries, timeouts and
+connection errors, per proxy and per endpoint.
+
+If metrics_file is set in the config file, a snapshot is written there
+every metrics_interval seconds during a survey (and once more at exit),
+either in the Prometheus text format (suitable for the node_exporter
+textfile collector) or as JSON.
+"""
+import atexit
+import collections
+import copy
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Number of recent latencies kept per proxy and endpoint, for quantiles
+LATENCY_WINDOW = 200
+
+# Quantiles are not reported until there are this many latencies
+LATENCY_MIN_SAMPLES = 20
+
+# Label for requests that do not go through a proxy
+DIRECT = "direct"
+
+_ID_PATTERN = re.compile(r"/[0-9]+(?=/|$)")
+
+
+def proxy_label(proxy):
+    """
+    The label for a proxy in the metrics: host:port, without any
+    user:password@ credentials in the proxy URL; DIRECT for no proxy.
+    """
+    if not proxy:
+        return DIRECT
+    (scheme, sep, rest) = proxy.rpartition("://")
+    return scheme + sep + rest.rpartition("@")[2]
+
+
+def escape_label(value):
+    """
+    A label value for the Prometheus text format: backslash, double quote
+    and newline are escaped.
+    """
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def endpoint_name(url):
+    """
+    The endpoint of a URL, for grouping: its path, with numeric ids
+    replaced so that all room pages count as one endpoint.
+    """
+    path = re.sub(r"^[a-z]+://[^/]*", "", url or "").split("?")[0]
+    return _ID_PATTERN.sub("/{id}", path) or "/"
+
+
+class ABRequestMetrics():
+    """
+    Thread-safe counters for web requests. Everything is keyed by
+    (proxy_label(proxy), endpoint); proxy None means a direct connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._series = {}
+        self._cache_hits = {}
+        self._hedges = {}
+        self._gauges = {}
+        # (proxy, endpoint) -> recent latencies of successful requests
+        self._latencies = {}
+
+    def _get(self, proxy, endpoint):
+        # call with the lock held
+        key = (proxy_label(proxy), endpoint)
+        series = self._series.get(key)
+        if series is None:
+            series = {
+                "status": {},
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                "latency_sum": 0.0,
+                "latency_count": 0,
+                "bytes": 0,
+                "timeouts": 0,
+                "errors": {},
+                "wait_seconds": 0.0,
+                "failed_seconds": 0.0,
+                "retries": 0,
+                "retries_shed": 0,
+                "deadlines_exceeded": 0,
+            }
+            self._series[key] = series
+        return series
+
+    def observe(self, proxy, url, status_code, elapsed, nbytes):
+        """ Record a completed request (any HTTP status) """
+        endpoint = endpoint_name(url)
+        with self._lock:
+            series = self._get(proxy, endpoint)
+            status = str(status_code)
+            series["status"][status] = series["status"].get(status, 0) + 1
+            for (i, bound) in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    series["buckets"][i] += 1
+                    break
+            else:
+                series["buckets"][-1] += 1
+            series["latency_sum"] += elapsed
+            series["latency_count"] += 1
+            series["bytes"] += nbytes
+            if status_code >= 300:
+                series["failed_seconds"] += elapsed
+            else:
+                key = (proxy_label(proxy), endpoint)
+                if key not in self._latencies:
+                    self._latencies[key] = collections.deque(maxlen=LATENCY_WINDOW)
+                self._latencies[key].append(elapsed)
+
+    def latency_quantile(self, proxy, url, quantile):
+        """
+        The given quantile (0 to 1) of recent successful request latencies
+        through proxy for the endpoint of url, or None if there are too
+        few to say.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(
+                (proxy_label(proxy), endpoint_name(url)), ()))
+        if len(latencies) < LATENCY_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+    def timeout(self, proxy, url, elapsed):
+        """ Record a request that timed out """
+        with self._lock:
+            series = self._get(proxy, endpoint_name(url))
+            series["timeouts"] += 1
+            series["failed_seconds"] += elapsed
+
+    def error(self, proxy, url, kind, elapsed):
+        """ Record a request that failed without an HTTP status """
+        with self._lock:
+            series = self._get(proxy, endpoint_name(url))
+            series["errors"][kind] = series["errors"].get(kind, 0) + 1
+            series["failed_seconds"] += elapsed
+
+    def wait(self, proxy, url, seconds):
+        """ Record time spent waiting for the rate controller or quarantine """
+        with self._lock:
+            self._get(proxy, endpoint_name(url))["wait_seconds"] += seconds
+
+    def retry(self, proxy, url):
+        """
+        Record a repeat attempt at a page, after a failed attempt through
+        proxy
+        """
+        with self._lock:
+            self._get(proxy, endpoint_name(url))["retries"] += 1
+
+    def retry_shed(self, proxy, url):
+        """ Record a retry not made because the retry budget was empty """
+        with self._lock:
+            self._get(proxy, endpoint_name(url))["retries_shed"] += 1
+
+    def deadline_exceeded(self, proxy, url):
+        """ Record a request abandoned at its deadline """
+        with self._lock:
+            self._get(proxy, endpoint_name(url))["deadlines_exceeded"] += 1
+
+    def gauge(self, name, value):
+        """ Set a gauge: a value that goes up and down """
+        with self._lock:
+            self._gauges[name] = value
+
+    def hedge(self, url, won):
+        """ Record a hedged request, and whether it answered first """
+        endpoint = endpoint_name(url)
+        with self._lock:
+            counts = self._hedges.setdefault(endpoint, {"sent": 0, "won": 0})
+            counts["sent"] += 1
+            if won:
+                counts["won"] += 1
+
+    def cache_hit(self, url):
+        """ Record a page read from the response cache """
+        endpoint = endpoint_name(url)
+        with self._lock:
+            self._cache_hits[endpoint] = self._cache_hits.get(endpoint, 0) + 1
+
+    def snapshot(self):
+        """ Return a copy of the metrics, as a JSON-serializable dict """
+        with self._lock:
+            series = []
+            for ((proxy, endpoint), values) in sorted(self._series.items()):
+                entry = copy.deepcopy(values)
+                entry["proxy"] = proxy
+                entry["endpoint"] = endpoint
+                series.append(entry)
+            return {
+                "started": self.started,
+                "time": time.time(),
+                "latency_buckets": list(LATENCY_BUCKETS),
+                "requests": series,
+                "cache_hits": dict(self._cache_hits),
+                "hedges": copy.deepcopy(self._hedges),
+                "gauges": dict(self._gauges),
+            }
+
+    def prometheus_text(self):
+        """ Return the metrics in the Prometheus text exposition format """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for (suffix, labels, value) in samples:
+                label_text = ",".join(
+                    '{}="{}"'.format(key, escape_label(val))
+                    for (key, val) in labels)
+                lines.append("{}{}{{{}}} {}".format(name, suffix, label_text, value))
+
+        def labels(entry, *extra):
+            return (("proxy", entry["proxy"]), ("endpoint", entry["endpoint"])) + extra
+
+        requests = snapshot["requests"]
+        metric("airbnb_requests_total", "counter",
+               "Completed web requests, by HTTP status.",
+               [("", labels(entry, ("status", status)), count)
+                for entry in requests
+                for (status, count) in sorted(entry["status"].items())])
+        samples = []
+        for entry in requests:
+            cumulative = 0
+            for (bound, count) in zip(LATENCY_BUCKETS, entry["buckets"]):
+                cumulative += count
+                samples.append(("_bucket", labels(entry, ("le", bound)), cumulative))
+            samples.append(("_bucket", labels(entry, ("le", "+Inf")),
+                            entry["latency_count"]))
+            samples.append(("_sum", labels(entry), round(entry["latency_sum"], 6)))
+            samples.append(("_count", labels(entry), entry["latency_count"]))
+        metric("airbnb_request_duration_seconds", "histogram",
+               "Latency of completed web requests.", samples)
+        metric("airbnb_response_bytes_total", "counter",
+               "Bytes of response content received.",
+               [("", labels(entry), entry["bytes"]) for entry in requests])
+        metric("airbnb_request_timeouts_total", "counter",
+               "Web requests that timed out.",
+               [("", labels(entry), entry["timeouts"]) for entry in requests])
+        metric("airbnb_request_errors_total", "counter",
+               "Web requests that failed without an HTTP status.",
+               [("", labels(entry, ("kind", kind)), count)
+                for entry in requests
+                for (kind, count) in sorted(entry["errors"].items())])
+        metric("airbnb_request_failed_seconds_total", "counter",
+               "Time spent on requests that did not return a page.",
+               [("", labels(entry), round(entry["failed_seconds"], 6))
+                for entry in requests])
+        metric("airbnb_request_wait_seconds_total", "counter",
+               "Time spent waiting for rate limits and proxy quarantine.",
+               [("", labels(entry), round(entry["wait_seconds"], 6))
+                for entry in requests])
+        metric("airbnb_request_retries_total", "counter",
+               "Repeat attempts at a page, by the proxy of the failed attempt.",
+               [("", labels(entry), entry["retries"]) for entry in requests])
+        metric("airbnb_request_retries_shed_total", "counter",
+               "Retries not made because the retry budget was empty.",
+               [("", labels(entry), entry["retries_shed"]) for entry in requests])
+        metric("airbnb_request_deadlines_exceeded_total", "counter",
+               "Requests abandoned at their deadline.",
+               [("", labels(entry), entry["deadlines_exceeded"])
+                for entry in requests])
+        metric("airbnb_request_hedges_total", "counter",
+               "Duplicate requests sent through a second proxy, and how many answered first.",
+               [("", (("endpoint", endpoint), ("outcome", outcome)), counts[outcome])
+                for (endpoint, counts) in sorted(snapshot["hedges"].items())
+                for outcome in ("sent", "won")])
+        metric("airbnb_cache_hits_total", "counter",
+               "Pages read from the response cache.",
+               [("", (("endpoint", endpoint),), count)
+                for (endpoint, count) in sorted(snapshot["cache_hits"].items())])
+        for (name, value) in sorted(snapshot["gauges"].items()):
+            lines.append("# TYPE airbnb_{} gauge".format(name))
+            lines.append("airbnb_{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, metrics_format="prometheus"):
+        """
+        Write a snapshot to path, replacing the file atomically so a
+        reader never sees a partial file.
+        """
+        if metrics_format == "json":
+            data = json.dumps(self.snapshot(), indent=1)
+        else:
+            data = self.prometheus_text()
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            (handle, temp_path) = tempfile.mkstemp(dir=directory)
+            with os.fdopen(handle, "w") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            LOGGER.exception("Failed to write metrics to %s", path)
+
+
+class ABMetricsWriter():
+    """
+    Writes a metrics snapshot to a file every `interval` seconds from a
+    daemon thread, and a final one when the process exits.
+    """
+
+    def __init__(self, metrics, path, metrics_format="prometheus", interval=30.0):
+        self.metrics = metrics
+        self.path = path
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-writer",
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        LOGGER.info("Writing request metrics to %s every %s seconds",
+                    self.path, self.interval)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.metrics.write(self.path, self.metrics_format)
+
+    def stop(self):
+        """ Stop the thread and write a final snapshot """
+        if not self._stop.is_set():
+            self._stop.set()
+            self.metrics.write(self.path, self.metrics_format)
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+"""
+Record and replay Airbnb web site responses, to measure survey
+performance without going to the network.
+
+Recording: set record_dir in the [NETWORK] section of the config file,
+and every page a survey retrieves (search pages and room pages) is saved
+there.
+
+Replaying: run this module as a script to serve the recorded pages from
+a local web server, optionally with added latency and injected errors:
+
+    python airbnb_replay.py -d recordings -p 8000 --latency 0.2 --error_rate 0.02
+
+and point url_api_search_root and url_room_root in a config file at it
+(http://localhost:8000/api/v2/explore_tabs, http://localhost:8000/rooms/).
+A survey (-sb) or fill (-f) run with that config file then uses the
+recorded pages.
+
+Pages are matched on the URL path and the query parameters, ignoring the
+host and the same session parameters as the response cache.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl
+from airbnb_cache import cache_key
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+
+def replay_key(url, params=None):
+    """ The key for a recorded page: the URL path and query parameters """
+    return cache_key(urlsplit(url).path, params)
+
+
+class ABRecorder():
+    """
+    Save pages as they are retrieved, one pair of files per page:
+    <key>.json holds the URL, parameters and status, and <key>.body.gz
+    the compressed body.
+    """
+
+    def __init__(self, record_dir):
+        self.record_dir = record_dir
+        self.count = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.record_dir, exist_ok=True)
+        LOGGER.info("Recording responses to %s", self.record_dir)
+
+    def _write(self, path, data):
+        (handle, temp_path) = tempfile.mkstemp(dir=self.record_dir)
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+    def record(self, url, params, response):
+        """ Save one response """
+        try:
+            key = replay_key(url, params)
+            headers = getattr(response, "headers", None) or {}
+            meta = {
+                "url": url,
+                "params": {name: str(value)
+                           for (name, value) in (params or {}).items()
+                           if value is not None},
+                "status": response.status_code,
+                "content_type": headers.get("Content-Type",
+                                            "application/octet-stream"),
+                "recorded": time.time(),
+            }
+            base = os.path.join(self.record_dir, key)
+            self._write(base + ".body.gz", gzip.compress(response.content))
+            self._write(base + ".json",
+                        json.dumps(meta, indent=1).encode("utf-8"))
+            with self._lock:
+                self.count += 1
+        except OSError:
+            LOGGER.exception("Failed to record response for %s", url)
+
+
+class ABReplayHandler(BaseHTTPRequestHandler):
+    """
+    Serve recorded pages. Settings are on the server object:
+    record_dir, latency, jitter, error_rate, error_status.
+    """
+
+    def log_message(self, format, *args):
+        LOGGER.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        # simulate the network
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with server.stats_lock:
+            server.stats["requests"] += 1
+        if server.error_rate > 0 and random.random() < server.error_rate:
+            with server.stats_lock:
+                server.stats["errors"] += 1
+            self.send_error(server.error_status)
+            return
+        base = os.path.join(server.record_dir, replay_key(url.path, params))
+        try:
+            with open(base + ".json", encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            with gzip.open(base + ".body.gz", "rb") as body_file:
+                body = body_file.read()
+        except FileNotFoundError:
+            with server.stats_lock:
+                server.stats["misses"] += 1
+            LOGGER.warning("No recording for %s", self.path)
+            self.send_error(404)
+            return
+        self.send_response(meta["status"])
+        self.send_header("Content-Type", meta["content_type"])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ABReplayServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server with a thread per request (http.server's
+    ThreadingHTTPServer needs Python 3.7)
+    """
+    daemon_threads = True
+
+
+def make_replay_server(record_dir, port=8000, latency=0.0, jitter=0.0,
+                       error_rate=0.0, error_status=500, host="localhost"):
+    """
+    Create (but do not start) a replay server. Call serve_forever() on the
+    result, possibly in a thread.
+    """
+    server = ABReplayServer((host, port), ABReplayHandler)
+    server.record_dir = record_dir
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.stats = {"requests": 0, "errors": 0, "misses": 0}
+    server.stats_lock = threading.Lock()
+    return server
+
+
+def parse_args():
+    """
+    Read and parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve recorded Airbnb pages from a local web server.")
+    parser.add_argument("-d", "--record_dir", required=True,
+                        help="directory of recorded pages (record_dir in the config file)")
+    parser.add_argument("-p", "--port", type=int, default=8000,
+                        help="port to listen on (default 8000)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before each response")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="up to this many further seconds, at random")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="fraction of requests to answer with an error")
+    parser.add_argument("--error_status", type=int, default=500,
+                        help="HTTP status for injected errors (default 500); "
+                        "403, 429 or 503 simulate being blocked, which "
+                        "quarantines the proxy")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="log every request")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main entry point for the replay server.
+    """
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)-15s %(levelname)-8s%(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    server = make_replay_server(args.record_dir, args.port, args.latency,
+                                args.jitter, args.error_rate, args.error_status)
+    LOGGER.info("Replaying %s on port %s", args.record_dir, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        LOGGER.info("Served %s requests: %s injected errors, %s not recorded",
+                    server.stats["requests"], server.stats["errors"],
+                    server.stats["misses"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""
+A compact set of room_ids, used by a survey to skip listings it has
+already saved without a trip to the database.
+
+The ids are kept in a sorted array of 64-bit integers (8 bytes an id,
+against about 70 for a Python set of ints), searched with bisect. New ids
+go into a small set first, which is merged into the array when it grows
+past a fraction of the array's size.
+"""
+import array
+import bisect
+import heapq
+import logging
+import threading
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+# The pending set is merged into the array when it holds more than this
+# many ids, or a fraction 1/MERGE_FRACTION of the array, whichever is more
+MERGE_MINIMUM = 1024
+MERGE_FRACTION = 16
+
+
+class ABRoomIdSet():
+    """
+    A thread-safe set of room_ids (integers).
+    """
+
+    def __init__(self, room_ids=()):
+        self._lock = threading.Lock()
+        self._sorted = array.array("q")
+        self._pending = set()
+        self.update(room_ids)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sorted) + len(self._pending)
+
+    def __contains__(self, room_id):
+        with self._lock:
+            return self._contains(room_id)
+
+    def _contains(self, room_id):
+        # call with the lock held
+        if room_id in self._pending:
+            return True
+        i = bisect.bisect_left(self._sorted, room_id)
+        return i < len(self._sorted) and self._sorted[i] == room_id
+
+    def add(self, room_id):
+        """
+        Add room_id to the set. Returns True if it was not already there.
+        """
+        with self._lock:
+            if self._contains(room_id):
+                return False
+            self._pending.add(room_id)
+            self._merge_if_full()
+            return True
+
+    def update(self, room_ids):
+        """ Add every room_id in an iterable """
+        with self._lock:
+            for room_id in room_ids:
+                if not self._contains(room_id):
+                    self._pending.add(room_id)
+            self._merge_if_full()
+
+    def _merge_if_full(self):
+        # call with the lock held
+        if len(self._pending) > max(MERGE_MINIMUM,
+                                    len(self._sorted) // MERGE_FRACTION):
+            self._sorted = array.array(
+                "q", heapq.merge(self._sorted, sorted(self._pending)))
+            self._pending.clear()
+
+
+def load_survey_room_ids(config, survey_id, batch_size=10000):
+    """
+    An ABRoomIdSet of the room_ids already saved in the room table for a
+    survey (or staged, with db_ingest = copy), for a survey that is resumed.
+    """
+    room_ids = ABRoomIdSet()
+    with config.pooled_connection() as conn:
+        cur = conn.cursor()
+        if config.DB_INGEST == "copy":
+            cur.execute("""
+                select room_id from room where survey_id = %s
+                union
+                select room_id from room_staging where survey_id = %s
+                """, (survey_id, survey_id))
+        else:
+            cur.execute("""
+                select room_id from room where survey_id = %s
+                """, (survey_id,))
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            room_ids.update(row[0] for row in rows)
+        cur.close()
+    LOGGER.info("Survey %s has %s listings already", survey_id, len(room_ids))
+    return room_ids
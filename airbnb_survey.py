@@ -9,16 +9,28 @@
 # - zipcode (-sz)
 # See the README for which to use.
 # ============================================================================
+import asyncio
 import logging
+import math
+import os
 import sys
 import random
 import psycopg2
+import socket
+import threading
 import time
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED,
+                                FIRST_EXCEPTION, wait)
 from datetime import date
 from bs4 import BeautifulSoup
 import json
-from airbnb_listing import ABListing
+from airbnb_listing import ABListing, ABListingWriter, merge_staged_listings
+from airbnb_listing import add_room_partition
+import airbnb_codec
+import airbnb_dbwriter
+import airbnb_roomset
 import airbnb_ws
+import airbnb_ws_async
 
 logger = logging.getLogger()
 
@@ -43,6 +55,8 @@ class ABSurvey():
     def __init__(self, config, survey_id):
         self.config = config
         self.survey_id = survey_id
+        # cached pages are read back only by this survey (when resumed)
+        config.CACHE_SCOPE = "survey {}".format(survey_id)
         self.search_area_id = None
         self.search_area_name = None
         self.set_search_area()
@@ -89,6 +103,7 @@ class ABSurvey():
             raise
 
     def update_survey_entry(self, search_by):
+        add_room_partition(self.config, self.survey_id)
         try:
             survey_info = (date.today(),
                            search_by,
@@ -236,11 +251,14 @@ class ABSurvey():
 
     def fini(self):
         """
-        Wrap up a survey: correcting status and survey_date
+        Wrap up a survey: merging any staged listings into room, and
+        correcting status and survey_date
         """
         try:
             logger.info("Finishing survey %s, for %s",
                         self.survey_id, self.search_area_name)
+            if self.config.DB_INGEST == "copy":
+                merge_staged_listings(self.config, self.survey_id)
             sql_update = """
             update survey
             set survey_date = (
@@ -320,6 +338,91 @@ class ABSurvey():
 
 
 
+# Status of a node in the survey_frontier_bb table
+FRONTIER_PENDING = "pending"
+FRONTIER_CLAIMED = "claimed"
+FRONTIER_DONE = "done"
+
+# Seconds a distributed worker waits before looking again for a node to
+# claim, when other workers are still searching
+FRONTIER_POLL_INTERVAL = 10
+
+
+def frontier_node_from_row(row):
+    """
+    A frontier node from the quadtree_node, median_node, section_offset,
+    items_offset, new_rooms and median_lists columns of survey_frontier_bb.
+    """
+    node = new_frontier_node(airbnb_codec.loads(row[0]),
+                             airbnb_codec.loads(row[1]))
+    node["section_offset"] = row[2]
+    node["items_offset"] = row[3]
+    node["new_rooms"] = row[4]
+    node["median_lists"] = airbnb_codec.loads(row[5])
+    return node
+
+
+def new_frontier_node(quadtree_node, median_node):
+    """
+    A node of a bounding box survey's frontier that has not been searched
+    (see ABSurveyByBoundingBox.frontier_pending).
+    """
+    return {
+        "quadtree": quadtree_node,
+        "median": median_node,
+        "section_offset": 0,
+        "items_offset": 0,
+        "new_rooms": 0,
+        "median_lists": {"latitude": [], "longitude": [], "price": []},
+    }
+
+
+def median_inside(values, low, high):
+    """
+    The median of values, if it lies strictly between low and high
+    (so that splitting there leaves two non-empty parts), or None.
+    """
+    if not values:
+        return None
+    median = round(sorted(values)[int(len(values)/2)], 5)
+    if low < median < high:
+        return median
+    return None
+
+
+def cancel_prefetched_pages(prefetched):
+    """
+    Cancel the page requests in prefetched (see
+    ABSurveyByBoundingBox.request_search_page) that have not started, and
+    forget them all: requests already under way run to completion, but
+    their responses are not used.
+    """
+    cancelled = 0
+    for (_, future) in prefetched.values():
+        if future.cancel():
+            cancelled += 1
+    logger.debug("Prefetched pages not used: %s (%s cancelled before the request)",
+                 len(prefetched), cancelled)
+    prefetched.clear()
+
+
+def child_leaves(split_point):
+    """
+    The quadtree leaves of the children of a node split at split_point
+    (see ABSurveyByBoundingBox.get_split_point): [0,0], [0,1], [1,0] and
+    [1,1] for a split on both axes, two of them for a split on one, and
+    [2,0] (the lower prices) and [2,1] (the higher) for a price split.
+    """
+    if isinstance(split_point, dict):
+        if "price" in split_point:
+            return [[2, 0], [2, 1]]
+        if split_point["lng"] is None:
+            return [[0, 0], [1, 0]]
+        if split_point["lat"] is None:
+            return [[0, 0], [0, 1]]
+    return [[0, 0], [0, 1], [1, 0], [1, 1]]
+
+
 class ABSurveyByBoundingBox(ABSurvey):
     """
     Subclass of Survey that carries out a survey by a quadtree of bounding
@@ -332,6 +435,14 @@ class ABSurveyByBoundingBox(ABSurvey):
         self.search_node_counter = 0
         self.logged_progress = self.get_logged_progress()
         self.bounding_box = self.get_bounding_box()
+        # listings saved by this survey (including before a resume), which
+        # are skipped when found again by overlapping rectangles
+        self.room_ids = airbnb_roomset.load_survey_room_ids(config, survey_id)
+        # the background database writer, while a search runs with
+        # db_writer_queue_size set
+        self.db_writer = None
+        # set to stop the distributed worker threads (see search_as_worker)
+        self.workers_stop = threading.Event()
 
     def get_logged_progress(self):
         """
@@ -416,6 +527,7 @@ class ABSurveyByBoundingBox(ABSurvey):
             ABSurvey.update_survey_entry(self, self.config.SEARCH_BY_BOUNDING_BOX)
             logger.info("Searching by bounding box, max_zoom=%s",
                         self.config.SEARCH_MAX_RECTANGLE_ZOOM)
+            self.start_db_writer(flag)
             # Initialize search parameters
             # quadtree_node holds the quadtree: each rectangle is
             # divided into 00 | 01 | 10 | 11, and the next level down adds
@@ -425,18 +537,551 @@ class ABSurveyByBoundingBox(ABSurvey):
             # set starting point for survey being resumed
             if self.logged_progress:
                 logger.info("Restarting incomplete survey")
+            # Surveys are tracked in the survey_frontier_bb table, except
+            # for printing and for surveys begun before it existed, which
+            # resume from survey_progress_log_bb
+            use_frontier = (flag == self.config.FLAGS_ADD
+                            and not (self.logged_progress
+                                     and not self.frontier_exists()))
+            workers = self.search_workers(flag) if use_frontier else 1
             if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
-                for room_type in self.room_types:
+                room_types = self.room_types
+            else:
+                room_types = [None]
+            for room_type in room_types:
+                if room_type is not None:
                     logger.info("-" * 70)
                     logger.info("Beginning of search for %s", room_type)
+                if not use_frontier:
                     self.recurse_quadtree(quadtree_node, median_node, room_type, flag)
+                    continue
+                pending = self.frontier_pending(room_type)
+                if workers > 1:
+                    self.search_quadtree_parallel(pending, room_type, flag, workers)
+                else:
+                    self.search_quadtree_serial(pending, room_type, flag)
+            self.stop_db_writer()
+            self.fini()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except airbnb_ws.ABRetryBudgetExhausted as ex:
+            logger.error("Stopping survey: %s. Run it again to resume.", ex)
+        except Exception:
+            logger.exception("Error")
+        finally:
+            self.abandon_db_writer()
+
+    def start_db_writer(self, flag):
+        """
+        With db_writer_queue_size set, start a background writer for the
+        listings and progress of the search (see airbnb_dbwriter).
+        """
+        if (self.config.DB_WRITER_QUEUE_SIZE > 0
+                and flag == self.config.FLAGS_ADD and self.db_writer is None):
+            self.db_writer = airbnb_dbwriter.ABDatabaseWriter(self.config)
+            self.db_writer.start()
+
+    def stop_db_writer(self):
+        """
+        Wait for the background writer to write everything queued, and
+        stop it. Re-raises any error it stopped on.
+        """
+        (db_writer, self.db_writer) = (self.db_writer, None)
+        if db_writer is not None:
+            db_writer.close()
+
+    def abandon_db_writer(self):
+        """
+        Stop the background writer when a search ends early (on an error,
+        Ctrl-C or SIGTERM), after it writes what was queued, so that a
+        resumed survey carries on from there.
+        """
+        try:
+            self.stop_db_writer()
+        except Exception:
+            # the writer has logged its error already
+            pass
+
+    def db_write(self, function, *args):
+        """
+        Call function(*args), which writes progress to the database:
+        straight away, or through the background writer if there is one,
+        after the listings queued before it.
+        """
+        if self.db_writer is None:
+            return function(*args)
+        self.db_writer.put_event(function, *args)
+        return None
+
+    def search_workers(self, flag):
+        """
+        The number of threads to explore the quadtree with: search_workers,
+        but no more than the number of proxies (a worker without a proxy
+        of its own would only wait on the rate limit of another), and
+        fewer than db_pool_max, as each worker holds a database connection
+        (as does the background writer, if there is one).
+        """
+        workers = self.config.SEARCH_WORKERS
+        if workers <= 1 or flag != self.config.FLAGS_ADD:
+            return 1
+        proxy_count = max(1, len(self.config.HTTP_PROXY_LIST_COMPLETE))
+        if workers > proxy_count:
+            logger.info("search_workers reduced from %s to %s, the number of proxies",
+                        workers, proxy_count)
+            workers = proxy_count
+        connections = self.config.DB_POOL_MAX - 1
+        if self.db_writer is not None:
+            connections -= 1
+        if workers > connections:
+            logger.info("search_workers reduced from %s to %s, to fit in db_pool_max",
+                        workers, max(1, connections))
+            workers = max(1, connections)
+        return workers
+
+    def search_quadtree_serial(self, pending, room_type, flag):
+        """
+        Explore the quadtree depth-first from the pending frontier nodes,
+        one node at a time.
+        """
+        stack = list(reversed(pending))
+        while stack:
+            children = self.search_frontier_node(stack.pop(), room_type, flag)
+            stack.extend(reversed(children))
+
+    def search_quadtree_parallel(self, pending, room_type, flag, workers):
+        """
+        Explore the quadtree from the pending frontier nodes with a pool of
+        worker threads. Once a node is known to be zoomable its four child
+        quadrants are independent, so each is queued as a separate task.
+        Tasks never wait for other tasks, so a bounded pool cannot deadlock.
+        If a task fails, or on Ctrl-C, the queued tasks are cancelled, so
+        only the nodes already being searched are finished.
+        """
+        logger.info("Searching quadtree with %s workers", workers)
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix="quadtree") as executor:
+            pending = {executor.submit(self.search_frontier_node,
+                                       node, room_type, flag)
+                       for node in pending}
+            try:
+                while pending:
+                    (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # re-raises any exception from the task
+                        for node in future.result():
+                            pending.add(executor.submit(
+                                self.search_frontier_node, node, room_type,
+                                flag))
+            finally:
+                # the frontier keeps cancelled nodes pending, for a resume
+                for future in pending:
+                    future.cancel()
+
+    def search_frontier_node(self, node, room_type, flag):
+        """
+        Search one pending frontier node, then mark it done and add its
+        children (if it is zoomable) to the frontier. Returns the children.
+        """
+        (zoomable, median_leaf) = self.search_node(
+            node["quadtree"], node["median"], room_type, flag,
+            log_progress=False, frontier_node=node)
+        children = []
+        if zoomable:
+            for quadtree_leaf in child_leaves(median_leaf):
+                children.append(new_frontier_node(
+                    node["quadtree"] + [quadtree_leaf],
+                    node["median"] + [median_leaf]))
+        self.db_write(self.frontier_complete, room_type, node, children)
+        return children
+
+    def search_as_worker(self, flag):
+        """
+        Take part in a distributed bounding box survey: several processes,
+        on one machine or many, each with its own proxies, share the
+        survey's frontier in the database. Each worker thread claims a
+        pending node (SELECT ... FOR UPDATE SKIP LOCKED), searches it, and
+        marks it done, adding its children if it is saturated. A claimed
+        node whose worker has not checkpointed it for
+        frontier_claim_timeout seconds is taken to be abandoned, and can be
+        claimed again. Workers stop when no node is pending or claimed.
+        """
+        try:
+            logger.info("=" * 70)
+            logger.info("Survey %s, for %s: distributed worker",
+                        self.survey_id, self.search_area_name)
+            ABSurvey.update_survey_entry(self, self.config.SEARCH_BY_BOUNDING_BOX)
+            if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
+                room_types = self.room_types
             else:
-                self.recurse_quadtree(quadtree_node, median_node, None, flag)
+                room_types = [None]
+            for room_type in room_types:
+                self.frontier_seed(room_type)
+            self.start_db_writer(flag)
+            workers = self.search_workers(flag)
+            logger.info("Searching frontier with %s worker threads", workers)
+            self.workers_stop.clear()
+            with ThreadPoolExecutor(max_workers=workers,
+                                    thread_name_prefix="frontier") as executor:
+                futures = [executor.submit(self.frontier_worker, flag)
+                           for _ in range(workers)]
+                try:
+                    (done, _) = wait(futures, return_when=FIRST_EXCEPTION)
+                    for future in done:
+                        # re-raises any exception from the worker
+                        future.result()
+                finally:
+                    # if a worker failed, or on Ctrl-C, the others stop
+                    # after the node they hold (see frontier_worker)
+                    self.workers_stop.set()
+                    for future in futures:
+                        future.cancel()
+            self.stop_db_writer()
             self.fini()
         except (SystemExit, KeyboardInterrupt):
             raise
+        except airbnb_ws.ABRetryBudgetExhausted as ex:
+            logger.error("Stopping worker: %s. Run it again to rejoin the survey.", ex)
         except Exception:
             logger.exception("Error")
+        finally:
+            self.abandon_db_writer()
+
+    def frontier_worker(self, flag):
+        """
+        One worker thread: claim and search frontier nodes until the
+        survey is complete, or until workers_stop is set.
+        """
+        worker_id = "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+                                      threading.current_thread().name)
+        while not self.workers_stop.is_set():
+            node = self.frontier_claim(worker_id)
+            if node is not None:
+                self.search_frontier_node(node, node["room_type"], flag)
+            elif self.frontier_active_count() > 0:
+                # other workers may yet add children of the nodes they hold
+                self.workers_stop.wait(FRONTIER_POLL_INTERVAL)
+            else:
+                logger.info("No frontier nodes left to search: %s stopping",
+                            worker_id)
+                return
+
+    def frontier_claim(self, worker_id):
+        """
+        Claim a pending (or abandoned) frontier node for this worker.
+        Returns the node, with its room_type, or None if there is none to
+        claim.
+        """
+        conn = self.config.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                update survey_frontier_bb f
+                set status = %s, worker = %s, last_modified = now()
+                from (
+                    select survey_id, room_type, quadtree_node
+                    from survey_frontier_bb
+                    where survey_id = %s
+                    and (status = %s
+                        or (status = %s
+                            and last_modified < now() - %s * interval '1 second'))
+                    order by room_type, quadtree_node
+                    limit 1
+                    for update skip locked
+                ) claim
+                where f.survey_id = claim.survey_id
+                and f.room_type = claim.room_type
+                and f.quadtree_node = claim.quadtree_node
+                returning f.quadtree_node, f.median_node, f.section_offset,
+                    f.items_offset, f.new_rooms, f.median_lists, f.room_type
+                """, (FRONTIER_CLAIMED, worker_id, self.survey_id,
+                      FRONTIER_PENDING, FRONTIER_CLAIMED,
+                      self.config.FRONTIER_CLAIM_TIMEOUT))
+            row = cur.fetchone()
+            cur.close()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception("Failed to claim a frontier node")
+            raise
+        if row is None:
+            return None
+        node = frontier_node_from_row(row)
+        node["room_type"] = row[6] or None
+        logger.debug("%s claimed node %s", worker_id, node["quadtree"])
+        return node
+
+    def frontier_active_count(self):
+        """ The number of frontier nodes that are pending or claimed """
+        conn = self.config.connect()
+        cur = conn.cursor()
+        cur.execute("""
+            select count(*) from survey_frontier_bb
+            where survey_id = %s and status in (%s, %s)
+            """, (self.survey_id, FRONTIER_PENDING, FRONTIER_CLAIMED))
+        count = cur.fetchone()[0]
+        cur.close()
+        conn.commit()
+        return count
+
+    def get_warm_start_nodes(self, room_type):
+        """
+        Return frontier nodes for the leaf rectangles of the most recent
+        completed survey of this search area (see save_leaves), or None if
+        there is no such survey or its leaves do not fit this survey (for
+        example, if the bounding box has changed). The upper levels of the
+        quadtree are always saturated, so starting from the leaves saves
+        the pages that would be spent on them.
+        """
+        conn = self.config.connect()
+        cur = conn.cursor()
+        cur.execute("""
+            select s.survey_id
+            from survey s
+            where s.search_area_id = %s and s.status = 1 and s.survey_id <> %s
+            and exists (select 1 from survey_leaf_bb l
+                        where l.survey_id = s.survey_id)
+            order by s.survey_date desc, s.survey_id desc
+            limit 1
+            """, (self.search_area_id, self.survey_id))
+        row = cur.fetchone()
+        if row is None:
+            cur.close()
+            conn.commit()
+            logger.info("No previous survey to warm start from")
+            return None
+        previous_survey_id = row[0]
+        cur.execute("""
+            select quadtree_node, median_node, n_lat, e_lng, s_lat, w_lng
+            from survey_leaf_bb
+            where survey_id = %s and room_type = %s
+            """, (previous_survey_id, room_type or ""))
+        rows = cur.fetchall()
+        cur.close()
+        conn.commit()
+        nodes = []
+        for row in rows:
+            node = new_frontier_node(airbnb_codec.loads(row[0]),
+                                     airbnb_codec.loads(row[1]))
+            rectangle = self.get_rectangle_from_quadtree_node(
+                node["quadtree"], node["median"])
+            if (rectangle is None or
+                    max(abs(a - float(b)) for (a, b) in zip(rectangle, row[2:6]))
+                    > 1e-5):
+                logger.warning("Leaf %s of survey %s does not match this survey's "
+                               "bounding box: not warm starting",
+                               node["quadtree"], previous_survey_id)
+                return None
+            nodes.append(node)
+        if nodes:
+            logger.info("Warm start from %s leaf rectangles of survey %s",
+                        len(nodes), previous_survey_id)
+        return nodes
+
+    def save_leaves(self):
+        """
+        Save the leaf rectangles of the completed frontier (nodes searched
+        without being split) to survey_leaf_bb, for later surveys of the
+        same search area to warm start from.
+        """
+        conn = self.config.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                select room_type, quadtree_node, median_node
+                from survey_frontier_bb
+                where survey_id = %s and status = %s
+                """, (self.survey_id, FRONTIER_DONE))
+            rows = cur.fetchall()
+            # a node is a leaf if none of its children is in the frontier
+            parents = set()
+            for (room_type, quadtree_node, median_node) in rows:
+                quadtree = airbnb_codec.loads(quadtree_node)
+                if quadtree:
+                    parents.add((room_type, json.dumps(quadtree[:-1])))
+            cur.execute("delete from survey_leaf_bb where survey_id = %s",
+                        (self.survey_id,))
+            leaf_count = 0
+            for (room_type, quadtree_node, median_node) in rows:
+                quadtree = airbnb_codec.loads(quadtree_node)
+                if (room_type, json.dumps(quadtree)) in parents:
+                    continue
+                rectangle = self.get_rectangle_from_quadtree_node(
+                    quadtree, airbnb_codec.loads(median_node))
+                cur.execute("""
+                    insert into survey_leaf_bb
+                    (survey_id, room_type, quadtree_node, median_node,
+                    n_lat, e_lng, s_lat, w_lng)
+                    values (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """, (self.survey_id, room_type, json.dumps(quadtree),
+                          median_node, rectangle[0], rectangle[1],
+                          rectangle[2], rectangle[3]))
+                leaf_count += 1
+            cur.close()
+            conn.commit()
+            logger.info("Saved %s leaf rectangles for survey %s",
+                        leaf_count, self.survey_id)
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception("Leaf rectangles not saved: later surveys cannot "
+                             "warm start from this one")
+
+    def fini(self):
+        """
+        Save the leaf rectangles of the survey, then wrap it up.
+        """
+        if self.frontier_exists():
+            self.save_leaves()
+        return super().fini()
+
+    def frontier_exists(self):
+        """ True if this survey has a frontier in survey_frontier_bb """
+        conn = self.config.connect()
+        cur = conn.cursor()
+        cur.execute("""
+            select exists(select 1 from survey_frontier_bb
+            where survey_id = %s)""", (self.survey_id,))
+        exists = cur.fetchone()[0]
+        cur.close()
+        conn.commit()
+        return exists
+
+    def frontier_seed(self, room_type):
+        """
+        Start the survey's frontier for this room type, if it does not
+        already have one: with the leaf rectangles of the previous survey
+        of the search area if search_warm_start is set (and they fit this
+        survey's bounding box), and otherwise with the whole bounding box.
+        """
+        conn = self.config.connect()
+        cur = conn.cursor()
+        cur.execute("""
+            select exists(select 1 from survey_frontier_bb
+            where survey_id = %s and room_type = %s)
+            """, (self.survey_id, room_type or ""))
+        exists = cur.fetchone()[0]
+        cur.close()
+        conn.commit()
+        if exists:
+            return
+        nodes = None
+        if self.config.SEARCH_WARM_START:
+            nodes = self.get_warm_start_nodes(room_type)
+        if not nodes:
+            nodes = [new_frontier_node([], [])]
+        conn = self.config.connect()
+        try:
+            cur = conn.cursor()
+            for node in nodes:
+                cur.execute("""
+                    insert into survey_frontier_bb
+                    (survey_id, room_type, quadtree_node, median_node,
+                    median_lists)
+                    values (%s, %s, %s, %s, %s)
+                    on conflict do nothing
+                    """, (self.survey_id, room_type or "",
+                          json.dumps(node["quadtree"]),
+                          json.dumps(node["median"]),
+                          json.dumps(node["median_lists"])))
+            cur.close()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception("Failed to seed the survey frontier")
+            raise
+
+    def frontier_pending(self, room_type):
+        """
+        Return the pending nodes of the survey's frontier for this room
+        type, seeding the frontier with the whole bounding box if the
+        survey is new. Returns [] if this part of the survey is complete.
+
+        Each node is a dict of its quadtree and median lists, and the
+        position reached in its pages: section_offset (the next page),
+        items_offset, new_rooms and median_lists.
+        """
+        self.frontier_seed(room_type)
+        conn = self.config.connect()
+        try:
+            cur = conn.cursor()
+            # claimed nodes are included: they were left by distributed
+            # workers that stopped
+            cur.execute("""
+                select quadtree_node, median_node, section_offset,
+                    items_offset, new_rooms, median_lists
+                from survey_frontier_bb
+                where survey_id = %s and room_type = %s and status in (%s, %s)
+                order by quadtree_node
+                """, (self.survey_id, room_type or "", FRONTIER_PENDING,
+                      FRONTIER_CLAIMED))
+            pending = [frontier_node_from_row(row) for row in cur.fetchall()]
+            cur.close()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception("Failed to read the survey frontier")
+            raise
+        if not pending:
+            logger.info("Frontier complete for room type %s", room_type)
+        elif pending[0]["quadtree"] or pending[0]["section_offset"]:
+            logger.info("Resuming survey from %s pending frontier nodes",
+                        len(pending))
+        return pending
+
+    def frontier_checkpoint(self, room_type, node):
+        """
+        Record the pages searched so far for a pending node, so that a
+        resumed survey carries on from the next page.
+        """
+        conn = self.config.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                update survey_frontier_bb
+                set section_offset = %s, items_offset = %s, new_rooms = %s,
+                    median_lists = %s, last_modified = now()
+                where survey_id = %s and room_type = %s and quadtree_node = %s
+                """, (node["section_offset"], node["items_offset"],
+                      node["new_rooms"], json.dumps(node["median_lists"]),
+                      self.survey_id, room_type or "",
+                      json.dumps(node["quadtree"])))
+            cur.close()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            logger.warning("Checkpoint not saved: a resumed survey may repeat pages")
+            logger.exception("Exception in frontier_checkpoint")
+
+    def frontier_complete(self, room_type, node, children):
+        """
+        Mark a node done and add its children to the frontier as pending,
+        in one transaction.
+        """
+        conn = self.config.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                update survey_frontier_bb
+                set status = %s, last_modified = now()
+                where survey_id = %s and room_type = %s and quadtree_node = %s
+                """, (FRONTIER_DONE, self.survey_id, room_type or "",
+                      json.dumps(node["quadtree"])))
+            for child in children:
+                cur.execute("""
+                    insert into survey_frontier_bb
+                    (survey_id, room_type, quadtree_node, median_node,
+                    median_lists)
+                    values (%s, %s, %s, %s, %s)
+                    on conflict do nothing
+                    """, (self.survey_id, room_type or "",
+                          json.dumps(child["quadtree"]),
+                          json.dumps(child["median"]),
+                          json.dumps(child["median_lists"])))
+            cur.close()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            logger.exception("Failed to update the survey frontier")
+            raise
 
     def recurse_quadtree(self, quadtree_node, median_node, room_type, flag):
         """
@@ -504,10 +1149,8 @@ class ABSurveyByBoundingBox(ABSurvey):
                 # append a node to the quadtree for a new level
                 quadtree_node.append([0,0])
                 median_node.append(median_leaf)
-                for int_leaf in range(4):
-                    # Loop over [0,0], [0,1], [1,0], [1,1]
-                    quadtree_leaf = [int(i)
-                                     for i in str(bin(int_leaf))[2:].zfill(2)]
+                for quadtree_leaf in child_leaves(median_leaf):
+                    # Loop over [0,0], [0,1], [1,0], [1,1] (or two of them)
                     quadtree_node[-1] = quadtree_leaf
                     self.recurse_quadtree(quadtree_node, median_node,
                                           room_type, flag)
@@ -523,6 +1166,8 @@ class ABSurveyByBoundingBox(ABSurvey):
                 sys.exit(0)
         except (SystemExit, KeyboardInterrupt):
             raise
+        except airbnb_ws.ABRetryBudgetExhausted:
+            raise
         except TypeError as type_error:
             logger.exception("TypeError in recurse_quadtree")
             logger.error(type_error.args)
@@ -531,16 +1176,33 @@ class ABSurveyByBoundingBox(ABSurvey):
             logger.exception("Error in recurse_quadtree")
             raise
 
-    def search_node(self, quadtree_node, median_node, room_type, flag):
+    def search_node(self, quadtree_node, median_node, room_type, flag,
+                    log_progress=True, frontier_node=None):
         """
             rectangle is (n_lat, e_lng, s_lat, w_lng)
             returns number of *new* rooms and number of pages tested
+            If frontier_node (see frontier_pending) is given, the search
+            starts from the page it records, and each page is checkpointed
+            to the frontier.
+            With search_prefetch_pages set, the pages after the current one
+            are requested while it is being processed.
         """
+        # pages requested ahead: section_offset -> (items_offset, future)
+        prefetched = {}
+        prefetch_executor = None
+        if (self.config.SEARCH_PREFETCH_PAGES > 0
+                and flag != self.config.FLAGS_PRINT):
+            prefetch_executor = ThreadPoolExecutor(
+                max_workers=self.config.SEARCH_PREFETCH_PAGES)
         try:
             logger.info("-" * 70)
             rectangle = self.get_rectangle_from_quadtree_node(quadtree_node, median_node)
+            price_band = self.get_price_band_from_quadtree_node(quadtree_node,
+                                                                median_node)
             logger.info("Searching rectangle: zoom factor = %s, node = %s",
                         len(quadtree_node), str(quadtree_node))
+            if price_band != (None, None):
+                logger.info("Price band: %s to %s", *price_band)
             logger.debug("Rectangle: N={n:+.5f}, E={e:+.5f}, S={s:+.5f}, W={w:+.5f}"
                          .format(n=rectangle[0], e=rectangle[1],
                                  s=rectangle[2], w=rectangle[3]))
@@ -555,12 +1217,22 @@ class ABSurveyByBoundingBox(ABSurvey):
             median_lists = {}
             median_lists["latitude"] = []
             median_lists["longitude"] = []
+            median_lists["price"] = []
             # As of October 2018, Airbnb uses items_offset in the URL for each new page,
             # which is the offset in the number of listings, rather than the
             # number of pages. Thanks to domatka78 for identifying the change.
             items_offset = 0
             room_count = 0
-            for section_offset in range(0, self.config.SEARCH_MAX_PAGES):
+            first_section_offset = 0
+            if frontier_node is not None:
+                # resume the node where its last checkpoint left it
+                first_section_offset = frontier_node["section_offset"]
+                items_offset = frontier_node["items_offset"]
+                new_rooms = frontier_node["new_rooms"]
+                median_lists = frontier_node["median_lists"]
+            page_number = first_section_offset
+            for section_offset in range(first_section_offset,
+                                        self.config.SEARCH_MAX_PAGES):
                 self.search_node_counter += 1
                 # section_offset is the zero-based counter used on the site
                 # page number is convenient for logging, etc
@@ -568,207 +1240,34 @@ class ABSurveyByBoundingBox(ABSurvey):
                 items_offset += room_count
                 room_count = 0
 
-                if self.config.API_KEY:
-                    # API (returns JSON)
-                    # set up the parameters for the request
-                    logger.debug("API key found: using API search at %s",
-                                 self.config.URL_API_SEARCH_ROOT)
-                    params = {}
-                    params["_format"] = "for_explore_search_web"
-                    params["_intents"] = "p1"
-                    params["adults"] = str(0)
-                    params["allow_override[]"] = ""
-                    params["auto_ib"] = str(False)
-                    params["children"] = str(0)
-                    params["client_session_id"] = self.config.CLIENT_SESSION_ID
-                    # params["currency"] = "CAD"
-                    params["experiences_per_grid"] = str(20)
-                    params["federated_search_session_id"] = "45de42ea-60d4-49a9-9335-9e52789cd306"
-                    params["fetch_filters"] = str(True)
-                    params["guests"] = str(0)
-                    params["guidebooks_per_grid"] = str(20)
-                    params["has_zero_guest_treatment"] = str(True)
-                    params["infants"] = str(0)
-                    params["is_guided_search"] = str(True)
-                    params["is_new_cards_experiment"] = str(True)
-                    params["is_standard_search"] = str(True)
-                    params["items_offset"] = str(18)
-                    params["items_per_grid"] = str(18)
-                    # params["locale"] = "en-CA"
-                    params["key"] = self.config.API_KEY
-                    params["luxury_pre_launch"] = str(False)
-                    params["metadata_only"] = str(False)
-                    # params["query"] = "Lisbon Portugal"
-                    params["query_understanding_enabled"] = str(True)
-                    params["refinement_paths[]"] = "/homes"
-                    if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
-                        params["room_types[]"] = room_type
-                    params["search_type"] = "PAGINATION"
-                    params["search_by_map"] = str(True)
-                    params["section_offset"] = section_offset
-                    params["selected_tab_id"] = "home_tab"
-                    params["show_groupings"] = str(True)
-                    params["supports_for_you_v3"] = str(True)
-                    params["timezone_offset"] = "-240"
-                    params["ne_lat"] = str(rectangle[0])
-                    params["ne_lng"] = str(rectangle[1])
-                    params["sw_lat"] = str(rectangle[2])
-                    params["sw_lng"] = str(rectangle[3])
-                    params["screen_size"] = "medium"
-                    params["zoom"] = str(True)
-                    # params["version"] = "1.4.8"
-                    if items_offset > 0:
-                        params["items_offset"]   = str(items_offset)
-                        # params["items_offset"]   = str(18*items_offset)
-                        params["section_offset"]   = str(8)
-                    # make the http request
-                    response = airbnb_ws.ws_request_with_repeats(
-                        self.config, self.config.URL_API_SEARCH_ROOT, params)
-                    # process the response
-                    if response:
-                        json_doc = json.loads(response.text)
-                    else:
-                        # If no response, maybe it's a network problem rather
-                        # than a lack of data.To be conservative go to the next page
-                        # rather than the next rectangle
-                        logger.warning(
-                            "No response received from request despite multiple attempts: %s",
-                            params)
-                        continue
-                else:
-                    # Web page (returns HTML)
-                    logger.debug("No API key found in config file: using web search at %s",
-                                 self.config.URL_API_SEARCH_ROOT)
-                    logger.warning("These results are probably wrong")
-                    logger.warning("See README for how to set an API key")
-                    params = {}
-                    params["source"] = "filter"
-                    params["_format"] = "for_explore_search_web"
-                    params["experiences_per_grid"] = str(20)
-                    params["items_per_grid"] = str(18)
-                    params["guidebooks_per_grid"] = str(20)
-                    params["auto_ib"] = str(True)
-                    params["fetch_filters"] = str(True)
-                    params["has_zero_guest_treatment"] = str(True)
-                    params["is_guided_search"] = str(True)
-                    params["is_new_cards_experiment"] = str(True)
-                    params["luxury_pre_launch"] = str(False)
-                    params["query_understanding_enabled"] = str(True)
-                    params["show_groupings"] = str(True)
-                    params["supports_for_you_v3"] = str(True)
-                    params["timezone_offset"] = "-240"
-                    params["metadata_only"] = str(False)
-                    params["is_standard_search"] = str(True)
-                    params["refinement_paths[]"] = "/homes"
-                    params["selected_tab_id"] = "home_tab"
-                    params["allow_override[]"] = ""
-                    params["ne_lat"] = str(rectangle[0])
-                    params["ne_lng"] = str(rectangle[1])
-                    params["sw_lat"] = str(rectangle[2])
-                    params["sw_lng"] = str(rectangle[3])
-                    params["search_by_map"] = str(True)
-                    params["screen_size"] = "medium"
-                    if section_offset > 0:
-                        params["section_offset"] = str(section_offset)
-                    # make the http request
-                    response = airbnb_ws.ws_request_with_repeats(
-                        self.config, self.config.URL_API_SEARCH_ROOT, params)
-                    # process the response
-                    if not response:
-                        # If no response, maybe it's a network problem rather
-                        # than a lack of data. To be conservative go to the next page
-                        # rather than the next rectangle
-                        logger.warning(
-                            "No response received from request despite multiple attempts: %s",
-                            params)
-                        continue
-                    soup = BeautifulSoup(response.content.decode("utf-8",
-                                                                 "ignore"),
-                                         "lxml")
-                    html_file = open("test.html", mode="w", encoding="utf-8")
-                    html_file.write(soup.prettify())
-                    html_file.close()
-                    # The returned page includes a script tag that encloses a
-                    # comment. The comment in turn includes a complex json
-                    # structure as a string, which has the data we need
-                    spaspabundlejs_set = soup.find_all("script",
-                                                       {"type": "application/json",
-                                                        "data-hypernova-key": "spaspabundlejs"})
-                    if spaspabundlejs_set:
-                        logger.debug("Found spaspabundlejs tag")
-                        comment = spaspabundlejs_set[0].contents[0]
-                        # strip out the comment tags (everything outside the
-                        # outermost curly braces)
-                        json_doc = json.loads(comment[comment.find("{"):comment.rfind("}")+1])
-                        logger.debug("results-containing json found")
-                    else:
-                        logger.warning("json results-containing script node "
-                                       "(spaspabundlejs) not found in the web page: "
-                                       "go to next page")
-                        return None
-                # Now we have the json. It includes a list of 18 or fewer listings
-                # if logger.isEnabledFor(logging.DEBUG):
-                    # json_file = open(
-                        # "json_listing_{}.json".format(self.search_node_counter),
-                        # mode="w", encoding="utf-8")
-                    # json_file.write(json.dumps(json_doc, indent=4, sort_keys=True))
-                    # json_file.close()
-                # Steal a function from StackOverflow which searches for items
-                # with a given list of keys (in this case just one: "listing")
-                # https://stackoverflow.com/questions/14048948/how-to-find-a-particular-json-value-by-key
-                def search_json_keys(key, json_doc):
-                    """ Return a list of the values for each occurrence of key
-                    in json_doc, at all levels. In particular, "listings"
-                    occurs more than once, and we need to get them all."""
-                    found = []
-                    if isinstance(json_doc, dict):
-                        if key in json_doc.keys():
-                            found.append(json_doc[key])
-                        elif json_doc.keys():
-                            for json_key in json_doc.keys():
-                                result_list = search_json_keys(key, json_doc[json_key])
-                                if result_list:
-                                    found.extend(result_list)
-                    elif isinstance(json_doc, list):
-                        for item in json_doc:
-                            result_list = search_json_keys(key, item)
-                            if result_list:
-                                found.extend(result_list)
-                    return found
-
-                # Get all items with tags "listings". Each json_listings is a
-                # list, and each json_listing is a {listing, pricing_quote, verified}
-                # dict for the listing in question
-                # There may be multiple lists of listings
-                json_listings_lists = search_json_keys("listings", json_doc)
-                # json_doc = json_doc["explore_tabs"]
-                # if json_doc: logger.debug("json: explore_tabs")
-                # json_doc = json_doc["sections"]
-                # if json_doc: logger.debug("json: sections")
-
-                if json_listings_lists is not None:
-                    room_count = 0
-                    for json_listings in json_listings_lists:
-                        if json_listings is None:
-                            continue
-                        for json_listing in json_listings:
-                            room_id = int(json_listing["listing"]["id"])
-                            if room_id is not None:
-                                room_count += 1
-                                listing = self.listing_from_search_page_json(json_listing, room_id)
-                                if listing is None:
-                                    continue
-                                if listing.latitude is not None:
-                                    median_lists["latitude"].append(listing.latitude)
-                                if listing.longitude is not None:
-                                    median_lists["longitude"].append(listing.longitude)
-                                if listing.host_id is not None:
-                                    listing.deleted = 0
-                                    if flag == self.config.FLAGS_ADD:
-                                        if listing.save(self.config.FLAGS_INSERT_NO_REPLACE):
-                                            new_rooms += 1
-                                    elif flag == self.config.FLAGS_PRINT:
-                                        print(listing.room_type, listing.room_id)
+                params = self.get_search_page_params(rectangle, room_type,
+                                                     section_offset, items_offset,
+                                                     price_band)
+                # make the http request (or collect the prefetched page)
+                response = self.request_search_page(
+                    rectangle, room_type, price_band, section_offset,
+                    items_offset, params, prefetch_executor, prefetched)
+                # process the response
+                if not response:
+                    # If no response, maybe it's a network problem rather
+                    # than a lack of data. To be conservative go to the next page
+                    # rather than the next rectangle, unless the retry
+                    # budget is used up: then the network is degraded, and
+                    # the survey stops so it can be resumed later
+                    logger.warning(
+                        "No response received from request despite multiple attempts: %s",
+                        params)
+                    if airbnb_ws.get_retry_budget(self.config).exhausted():
+                        raise airbnb_ws.ABRetryBudgetExhausted(
+                            "no page for {} and no retries left".format(quadtree_node))
+                    continue
+                json_listings_lists = self.get_listings_from_search_response(response)
+                if json_listings_lists is None:
+                    # not a search page: search no further in this node
+                    return (False, None)
+                (room_count, page_new_rooms) = self.save_search_page_listings(
+                    json_listings_lists, flag, median_lists)
+                new_rooms += page_new_rooms
 
                 # Log page-level results
                 logger.info("Page {page_number:02d} returned {room_count:02d} listings"
@@ -776,42 +1275,22 @@ class ABSurveyByBoundingBox(ABSurvey):
                 if flag == self.config.FLAGS_PRINT:
                     # for FLAGS_PRINT, fetch one page and print it
                     sys.exit(0)
+                if frontier_node is not None:
+                    frontier_node["section_offset"] = section_offset + 1
+                    frontier_node["items_offset"] = items_offset + room_count
+                    frontier_node["new_rooms"] = new_rooms
+                    self.db_write(self.frontier_checkpoint, room_type,
+                                  frontier_node)
                 if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
                     # If a full page of listings is not returned by Airbnb,
-                    # this branch of the search is complete.
+                    # this branch of the search is complete, and any pages
+                    # requested ahead are not needed.
                     logger.info("Final page of listings for this search")
                     zoomable = False
                     break
-            # Log node-level results
-            if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
-                logger.info("Results: %s pages, %s new %s listings.",
-                            page_number, new_rooms, room_type)
-            else:
-                logger.info("Results: %s pages, %s new rooms",
-                            page_number, new_rooms)
-
-
-
-            # Median-based partitioning not currently in use: may use later
-            if len(median_node) == 0:
-                median_leaf = "[]"
-            else:
-                median_leaf = median_node[-1]
-            # calculate medians
-            if room_count > 0:
-                median_lat = round(sorted(median_lists["latitude"])
-                                   [int(len(median_lists["latitude"])/2)], 5
-                                  )
-                median_lng = round(sorted(median_lists["longitude"])
-                                   [int(len(median_lists["longitude"])/2)], 5
-                                  )
-                median_leaf = [median_lat, median_lng]
-            else:
-                # values not needed, but we need to fill in an item anyway
-                median_leaf = [0, 0]
-            # log progress
-            self.log_progress(room_type, quadtree_node, median_node)
-            return (zoomable, median_leaf)
+            return self.finish_search_node(quadtree_node, median_node, room_type,
+                                           page_number, room_count, new_rooms,
+                                           median_lists, zoomable, log_progress)
         except UnicodeEncodeError:
             logger.error("UnicodeEncodeError: set PYTHONIOENCODING=utf-8")
             # if sys.version_info >= (3,):
@@ -819,9 +1298,384 @@ class ABSurveyByBoundingBox(ABSurvey):
             # else:
             #    logger.info(s.encode('utf8'))
             # unhandled at the moment
+        except airbnb_ws.ABRetryBudgetExhausted:
+            raise
         except Exception:
             logger.exception("Exception in get_search_page_info_rectangle")
             raise
+        finally:
+            if prefetched:
+                cancel_prefetched_pages(prefetched)
+            if prefetch_executor is not None:
+                prefetch_executor.shutdown(wait=False)
+
+    def request_search_page(self, rectangle, room_type, price_band,
+                            section_offset, items_offset, params,
+                            prefetch_executor, prefetched):
+        """
+        Return the response for one page of a rectangle search. If
+        prefetch_executor is given, the next search_prefetch_pages pages
+        are requested in the background first, on the assumption that
+        every page up to them is full; the response for this page comes
+        from an earlier prefetch if there is one for the same items_offset.
+        """
+        entry = prefetched.pop(section_offset, None)
+        if entry is not None and entry[0] != items_offset:
+            # A page before this one was not full (or was not retrieved),
+            # so the prefetched pages are for the wrong offsets.
+            logger.debug("Discarding prefetched pages from page %s",
+                         section_offset + 1)
+            entry[1].cancel()
+            entry = None
+            cancel_prefetched_pages(prefetched)
+        if prefetch_executor is not None:
+            for ahead in range(1, self.config.SEARCH_PREFETCH_PAGES + 1):
+                next_section_offset = section_offset + ahead
+                if (next_section_offset >= self.config.SEARCH_MAX_PAGES
+                        or next_section_offset in prefetched):
+                    continue
+                next_items_offset = (items_offset + ahead *
+                                     self.config.SEARCH_LISTINGS_ON_FULL_PAGE)
+                next_params = self.get_search_page_params(
+                    rectangle, room_type, next_section_offset, next_items_offset,
+                    price_band)
+                prefetched[next_section_offset] = (
+                    next_items_offset,
+                    prefetch_executor.submit(
+                        airbnb_ws.ws_request_with_repeats, self.config,
+                        self.config.URL_API_SEARCH_ROOT, next_params,
+                        hedge=True))
+        if entry is not None:
+            return entry[1].result()
+        return airbnb_ws.ws_request_with_repeats(
+            self.config, self.config.URL_API_SEARCH_ROOT, params, hedge=True)
+
+    def get_search_page_params(self, rectangle, room_type, section_offset,
+                               items_offset, price_band=(None, None)):
+        """
+        Build the query parameters for one page of a rectangle search.
+        price_band is (price_min, price_max): see
+        get_price_band_from_quadtree_node.
+        """
+        if self.config.API_KEY:
+            # API (returns JSON)
+            # set up the parameters for the request
+            logger.debug("API key found: using API search at %s",
+                         self.config.URL_API_SEARCH_ROOT)
+            params = {}
+            params["_format"] = "for_explore_search_web"
+            params["_intents"] = "p1"
+            params["adults"] = str(0)
+            params["allow_override[]"] = ""
+            params["auto_ib"] = str(False)
+            params["children"] = str(0)
+            params["client_session_id"] = self.config.CLIENT_SESSION_ID
+            # params["currency"] = "CAD"
+            params["experiences_per_grid"] = str(20)
+            params["federated_search_session_id"] = "45de42ea-60d4-49a9-9335-9e52789cd306"
+            params["fetch_filters"] = str(True)
+            params["guests"] = str(0)
+            params["guidebooks_per_grid"] = str(20)
+            params["has_zero_guest_treatment"] = str(True)
+            params["infants"] = str(0)
+            params["is_guided_search"] = str(True)
+            params["is_new_cards_experiment"] = str(True)
+            params["is_standard_search"] = str(True)
+            params["items_offset"] = str(18)
+            params["items_per_grid"] = str(18)
+            # params["locale"] = "en-CA"
+            params["key"] = self.config.API_KEY
+            params["luxury_pre_launch"] = str(False)
+            params["metadata_only"] = str(False)
+            # params["query"] = "Lisbon Portugal"
+            params["query_understanding_enabled"] = str(True)
+            params["refinement_paths[]"] = "/homes"
+            if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
+                params["room_types[]"] = room_type
+            params["search_type"] = "PAGINATION"
+            params["search_by_map"] = str(True)
+            params["section_offset"] = section_offset
+            params["selected_tab_id"] = "home_tab"
+            params["show_groupings"] = str(True)
+            params["supports_for_you_v3"] = str(True)
+            params["timezone_offset"] = "-240"
+            params["ne_lat"] = str(rectangle[0])
+            params["ne_lng"] = str(rectangle[1])
+            params["sw_lat"] = str(rectangle[2])
+            params["sw_lng"] = str(rectangle[3])
+            params["screen_size"] = "medium"
+            params["zoom"] = str(True)
+            # params["version"] = "1.4.8"
+            if items_offset > 0:
+                params["items_offset"]   = str(items_offset)
+                # params["items_offset"]   = str(18*items_offset)
+                params["section_offset"]   = str(8)
+        else:
+            # Web page (returns HTML)
+            logger.debug("No API key found in config file: using web search at %s",
+                         self.config.URL_API_SEARCH_ROOT)
+            logger.warning("These results are probably wrong")
+            logger.warning("See README for how to set an API key")
+            params = {}
+            params["source"] = "filter"
+            params["_format"] = "for_explore_search_web"
+            params["experiences_per_grid"] = str(20)
+            params["items_per_grid"] = str(18)
+            params["guidebooks_per_grid"] = str(20)
+            params["auto_ib"] = str(True)
+            params["fetch_filters"] = str(True)
+            params["has_zero_guest_treatment"] = str(True)
+            params["is_guided_search"] = str(True)
+            params["is_new_cards_experiment"] = str(True)
+            params["luxury_pre_launch"] = str(False)
+            params["query_understanding_enabled"] = str(True)
+            params["show_groupings"] = str(True)
+            params["supports_for_you_v3"] = str(True)
+            params["timezone_offset"] = "-240"
+            params["metadata_only"] = str(False)
+            params["is_standard_search"] = str(True)
+            params["refinement_paths[]"] = "/homes"
+            params["selected_tab_id"] = "home_tab"
+            params["allow_override[]"] = ""
+            params["ne_lat"] = str(rectangle[0])
+            params["ne_lng"] = str(rectangle[1])
+            params["sw_lat"] = str(rectangle[2])
+            params["sw_lng"] = str(rectangle[3])
+            params["search_by_map"] = str(True)
+            params["screen_size"] = "medium"
+            if section_offset > 0:
+                params["section_offset"] = str(section_offset)
+        (price_min, price_max) = price_band
+        if price_min is not None:
+            params["price_min"] = str(price_min)
+        if price_max is not None:
+            params["price_max"] = str(price_max)
+        return params
+
+    def get_listings_from_search_response(self, response):
+        """
+        Return the lists of listings in a search response (see
+        save_search_page_listings), or None if the response does not hold
+        the expected json. API responses are decoded from the bytes, and
+        only the explore_tabs -> sections -> listings path is walked (see
+        airbnb_codec).
+        """
+        if self.config.API_KEY:
+            return airbnb_codec.listings_from_search_json(response.content)
+        json_doc = self.get_json_from_search_response(response)
+        if json_doc is None:
+            return None
+        return airbnb_codec.listings_from_search_doc(json_doc)
+
+    def get_json_from_search_response(self, response):
+        """
+        Return the json document from a search response: the API returns
+        JSON directly, while the web page embeds it in a script tag.
+        Returns None if the web page does not hold the expected json.
+        """
+        if self.config.API_KEY:
+            return airbnb_codec.loads(response.content)
+        soup = BeautifulSoup(response.content.decode("utf-8",
+                                                     "ignore"),
+                             "lxml")
+        html_file = open("test.html", mode="w", encoding="utf-8")
+        html_file.write(soup.prettify())
+        html_file.close()
+        # The returned page includes a script tag that encloses a
+        # comment. The comment in turn includes a complex json
+        # structure as a string, which has the data we need
+        spaspabundlejs_set = soup.find_all("script",
+                                           {"type": "application/json",
+                                            "data-hypernova-key": "spaspabundlejs"})
+        if spaspabundlejs_set:
+            logger.debug("Found spaspabundlejs tag")
+            comment = spaspabundlejs_set[0].contents[0]
+            # strip out the comment tags (everything outside the
+            # outermost curly braces)
+            json_doc = airbnb_codec.loads(comment[comment.find("{"):comment.rfind("}")+1])
+            logger.debug("results-containing json found")
+            return json_doc
+        else:
+            logger.warning("json results-containing script node "
+                           "(spaspabundlejs) not found in the web page: "
+                           "go to next page")
+            return None
+
+    def save_search_page_listings(self, json_listings_lists, flag, median_lists):
+        """
+        Save (or print) the listings on one search page.
+        json_listings_lists holds the "listings" lists from the page's json:
+        each is a list, and each json_listing is a
+        {listing, pricing_quote, verified} dict for the listing in question.
+        Returns (room_count, new_rooms): the number of listings on the
+        page, and the number of those that were new to this survey.
+        """
+        room_count = 0
+        new_rooms = 0
+        # listings new to this process are written together, at the end
+        writer = ABListingWriter(self.config)
+        written = []
+        if json_listings_lists is not None:
+            for json_listings in json_listings_lists:
+                if json_listings is None:
+                    continue
+                for json_listing in json_listings:
+                    room_id = int(json_listing["listing"]["id"])
+                    if room_id is not None:
+                        room_count += 1
+                        listing = self.listing_from_search_page_json(json_listing, room_id)
+                        if listing is None:
+                            continue
+                        if listing.latitude is not None:
+                            median_lists["latitude"].append(listing.latitude)
+                        if listing.longitude is not None:
+                            median_lists["longitude"].append(listing.longitude)
+                        if listing.price is not None:
+                            # absent from frontier nodes saved before prices
+                            median_lists.setdefault("price", []).append(listing.price)
+                        if listing.host_id is not None:
+                            listing.deleted = 0
+                            if flag == self.config.FLAGS_ADD:
+                                if room_id in self.room_ids:
+                                    # already saved: no need to ask the database
+                                    continue
+                                if self.db_writer is not None:
+                                    # counted as new when queued, as the
+                                    # writer saves it in the background
+                                    if self.room_ids.add(room_id):
+                                        self.db_writer.put_listing(listing)
+                                        new_rooms += 1
+                                    continue
+                                written.append(room_id)
+                                inserted = writer.add(listing)
+                                new_rooms += len(inserted)
+                            elif flag == self.config.FLAGS_PRINT:
+                                print(listing.room_type, listing.room_id)
+        inserted = writer.flush()
+        new_rooms += len(inserted)
+        # saved now, or already saved by another worker
+        self.room_ids.update(room_id for room_id in written
+                             if room_id not in writer.failed)
+        return (room_count, new_rooms)
+
+    def finish_search_node(self, quadtree_node, median_node, room_type,
+                           page_number, room_count, new_rooms, median_lists,
+                           zoomable, log_progress=True):
+        """
+        Log the results for a searched node, compute its medians and record
+        progress. Returns (zoomable, median_leaf) as search_node does.
+        """
+        # Log node-level results
+        if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
+            logger.info("Results: %s pages, %s new %s listings.",
+                        page_number, new_rooms, room_type)
+        else:
+            logger.info("Results: %s pages, %s new rooms",
+                        page_number, new_rooms)
+
+
+
+        # the split point of the node, for its children
+        median_leaf = self.get_split_point(quadtree_node, median_node,
+                                           median_lists)
+        if zoomable and median_leaf is None:
+            logger.warning("Node %s is full, but its price band (%s to %s) "
+                           "cannot be split further", quadtree_node,
+                           *self.get_price_band_from_quadtree_node(
+                               quadtree_node, median_node))
+            zoomable = False
+        # log progress
+        if log_progress:
+            self.db_write(self.log_progress, room_type, quadtree_node,
+                          median_node)
+        return (zoomable, median_leaf)
+
+    def get_split_point(self, quadtree_node, median_node, median_lists):
+        """
+        Return the point at which to split the rectangle of a node, as
+        {"lat": split_lat, "lng": split_lng}, following the
+        search_split_strategy in the config file. A None coordinate means
+        the rectangle is not split along that axis (kd splits only one).
+        If search_do_loop_over_prices is set, a node at the maximum zoom is
+        split by price instead (see get_price_split_point), or not at all
+        (None) once its price band cannot be split. Otherwise rectangles are
+        split whatever their zoom.
+        """
+        if (self.config.SEARCH_DO_LOOP_OVER_PRICES and
+                len(quadtree_node) >= self.config.SEARCH_MAX_RECTANGLE_ZOOM):
+            return self.get_price_split_point(quadtree_node, median_node,
+                                              median_lists)
+        rectangle = self.get_rectangle_from_quadtree_node(quadtree_node,
+                                                          median_node)
+        [n_lat, e_lng, s_lat, w_lng] = rectangle
+        midpoint = {"lat": (n_lat + s_lat) / 2.0, "lng": (e_lng + w_lng) / 2.0}
+        strategy = self.config.SEARCH_SPLIT_STRATEGY
+        if strategy == "midpoint":
+            return midpoint
+        # Listings found outside the rectangle (Airbnb pads the search area)
+        # are ignored by median_inside: fall back to the midpoint if there are
+        # none inside.
+        median_lat = median_inside(median_lists["latitude"], s_lat, n_lat)
+        median_lng = median_inside(median_lists["longitude"], w_lng, e_lng)
+        if median_lat is None:
+            median_lat = midpoint["lat"]
+        if median_lng is None:
+            median_lng = midpoint["lng"]
+        if strategy == "median":
+            split = {"lat": median_lat, "lng": median_lng}
+        else:
+            # kd: split across the longer side. A degree of longitude is
+            # shorter than a degree of latitude, by cos(latitude).
+            height = n_lat - s_lat
+            width = (e_lng - w_lng) * math.cos(math.radians(midpoint["lat"]))
+            if height >= width:
+                split = {"lat": median_lat, "lng": None}
+            else:
+                split = {"lat": None, "lng": median_lng}
+        logger.debug("Split point (%s): %s", strategy, split)
+        return split
+
+    def get_price_split_point(self, quadtree_node, median_node, median_lists):
+        """
+        Return the price at which to split the price band of a node, as
+        {"price": split_price}: the lower band is up to and including
+        split_price, and the upper band above it. The split is at the median
+        price of the listings found, so that each band holds about half of
+        them, or at the middle of the band if that is not inside it.
+        Returns None if the band cannot be split any further.
+        """
+        (price_min, price_max) = self.get_price_band_from_quadtree_node(
+            quadtree_node, median_node)
+        low = -1 if price_min is None else price_min - 1
+        high = float("inf") if price_max is None else price_max
+        prices = median_lists.get("price", [])
+        split_price = None
+        if prices:
+            split_price = int(sorted(prices)[int(len(prices)/2)])
+        if split_price is None or not low < split_price < high:
+            split_price = None
+            if price_max is not None and price_max - (low + 1) >= 1:
+                split_price = int((low + 1 + price_max) / 2)
+        if split_price is None:
+            return None
+        logger.debug("Price split point: %s", split_price)
+        return {"price": split_price}
+
+    def get_price_band_from_quadtree_node(self, quadtree_node, median_node):
+        """
+        Return (price_min, price_max) for a node: the bounds set by its
+        price splits (see get_price_split_point), or None where there are
+        none.
+        """
+        price_min = None
+        price_max = None
+        for node, medians in zip(quadtree_node, median_node):
+            if isinstance(medians, dict) and "price" in medians:
+                if node == [2, 0]:
+                    price_max = medians["price"]
+                else:
+                    price_min = medians["price"] + 1
+        return (price_min, price_max)
 
     def get_rectangle_from_quadtree_node(self, quadtree_node, median_node):
         try:
@@ -829,36 +1683,42 @@ class ABSurveyByBoundingBox(ABSurvey):
             for node, medians in zip(quadtree_node, median_node):
                 logger.debug("Quadtrees: %s", node)
                 logger.debug("Medians: %s", medians)
+                if isinstance(medians, dict) and "price" in medians:
+                    # a price split leaves the rectangle as it is
+                    continue
                 [n_lat, e_lng, s_lat, w_lng] = rectangle
                 blur = abs(n_lat - s_lat) * self.config.SEARCH_RECTANGLE_EDGE_BLUR
-                # find the mindpoints of the rectangle
-                mid_lat = (n_lat + s_lat)/2.0
-                mid_lng = (e_lng + w_lng)/2.0
-                # mid_lat = medians[0]
-                # mid_lng = medians[1]
+                if isinstance(medians, dict):
+                    # the split point stored by get_split_point
+                    mid_lat = medians["lat"]
+                    mid_lng = medians["lng"]
+                else:
+                    # progress logged before split points were stored:
+                    # these were always split at the midpoints
+                    mid_lat = (n_lat + s_lat)/2.0
+                    mid_lng = (e_lng + w_lng)/2.0
+                # node[0] is 0 for the northern part and 1 for the southern;
+                # node[1] is 0 for the eastern part and 1 for the western.
+                # An axis that was not split keeps both its edges.
+                if node not in ([0, 0], [0, 1], [1, 0], [1, 1]):
+                    rectangle = []
+                    break
+                if mid_lat is not None:
+                    if node[0] == 0:
+                        s_lat = mid_lat
+                    else:
+                        n_lat = mid_lat
+                if mid_lng is not None:
+                    if node[1] == 0:
+                        w_lng = mid_lng
+                    else:
+                        e_lng = mid_lng
                 # overlap quadrants to ensure coverage at high zoom levels
                 # Airbnb max zoom (18) is about 0.004 on a side.
-                rectangle = []
-                if node == [0, 0]: # NE
-                    rectangle = [round(n_lat + blur, 5),
-                                 round(e_lng + blur, 5),
-                                 round(mid_lat - blur, 5),
-                                 round(mid_lng - blur, 5),]
-                elif node == [0, 1]: # NW
-                    rectangle = [round(n_lat + blur, 5),
-                                 round(mid_lng + blur, 5),
-                                 round(mid_lat - blur, 5),
-                                 round(w_lng - blur, 5),]
-                elif node == [1, 0]: # SE
-                    rectangle = [round(mid_lat + blur, 5),
-                                 round(e_lng + blur, 5),
-                                 round(s_lat - blur, 5),
-                                 round(mid_lng - blur, 5),]
-                elif node == [1, 1]: # SW
-                    rectangle = [round(mid_lat + blur, 5),
-                                 round(mid_lng + blur, 5),
-                                 round(s_lat - blur, 5),
-                                 round(w_lng - blur, 5),]
+                rectangle = [round(n_lat + blur, 5),
+                             round(e_lng + blur, 5),
+                             round(s_lat - blur, 5),
+                             round(w_lng - blur, 5),]
             logger.info("Rectangle calculated: %s", rectangle)
             return rectangle
         except:
@@ -933,6 +1793,156 @@ class ABSurveyByBoundingBox(ABSurvey):
 
 
 
+class ABSurveyByBoundingBoxAsync(ABSurveyByBoundingBox):
+    """
+    Subclass of the bounding box survey that fetches pages with the asyncio
+    engine in airbnb_ws_async. Sibling quadrants are searched concurrently,
+    so that up to async_concurrency requests are in flight at once.
+    Listings are saved through ABListing, as in the sequential survey, on
+    a thread of their own so that fetching carries on meanwhile.
+
+    Progress is not logged in this mode, as there is no single "current"
+    node to resume from: a truncated survey is started again from the top,
+    and listings that were already saved are skipped as duplicates.
+    """
+
+    def search(self, flag):
+        """
+        Initialize an asynchronous bounding box search. See
+        ABSurveyByBoundingBox.search for the rectangle conventions.
+        """
+        try:
+            logger.info("=" * 70)
+            logger.info("Survey {survey_id}, for {search_area_name}".format(
+                survey_id=self.survey_id, search_area_name=self.search_area_name
+            ))
+            ABSurvey.update_survey_entry(self, self.config.SEARCH_BY_BOUNDING_BOX)
+            logger.info("Searching by bounding box, max_zoom=%s, "
+                        "up to %s concurrent requests",
+                        self.config.SEARCH_MAX_RECTANGLE_ZOOM,
+                        self.config.ASYNC_CONCURRENCY)
+            if self.logged_progress:
+                logger.warning("Logged progress is not used by asynchronous "
+                               "searches: searching the whole bounding box")
+            self.start_db_writer(flag)
+            # listings are saved on a thread of their own, so that the event
+            # loop goes on fetching pages while the database is written to
+            self.db_executor = ThreadPoolExecutor(max_workers=1,
+                                                  thread_name_prefix="dbsave")
+            try:
+                # asyncio.run needs Python 3.7: the docker image has 3.6
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(self.search_async(flag))
+            finally:
+                self.db_executor.submit(self.config.release_connection)
+                self.db_executor.shutdown()
+            self.stop_db_writer()
+            self.fini()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except airbnb_ws.ABRetryBudgetExhausted as ex:
+            logger.error("Stopping survey: %s. Run it again to resume.", ex)
+        except Exception:
+            logger.exception("Error")
+        finally:
+            self.abandon_db_writer()
+
+    async def search_async(self, flag):
+        async with airbnb_ws_async.ABAsyncFetcher(self.config) as fetcher:
+            if self.config.SEARCH_DO_LOOP_OVER_ROOM_TYPES:
+                for room_type in self.room_types:
+                    logger.info("-" * 70)
+                    logger.info("Beginning of search for %s", room_type)
+                    await self.recurse_quadtree_async(fetcher, [], [],
+                                                      room_type, flag)
+            else:
+                await self.recurse_quadtree_async(fetcher, [], [], None, flag)
+
+    async def recurse_quadtree_async(self, fetcher, quadtree_node, median_node,
+                                     room_type, flag):
+        """
+        Search a node and, if it is zoomable, its four child quadrants
+        concurrently. Each call gets its own copy of the node lists, as
+        sibling searches run at the same time.
+        """
+        (zoomable, median_leaf) = await self.search_node_async(
+            fetcher, quadtree_node, median_node, room_type, flag)
+        if zoomable:
+            children = []
+            for quadtree_leaf in child_leaves(median_leaf):
+                children.append(self.recurse_quadtree_async(
+                    fetcher, quadtree_node + [quadtree_leaf],
+                    median_node + [median_leaf], room_type, flag))
+            await asyncio.gather(*children)
+        logger.debug("Returning from recurse_quadtree_async for %s", quadtree_node)
+
+    async def search_node_async(self, fetcher, quadtree_node, median_node,
+                                room_type, flag):
+        """
+        Asynchronous counterpart of ABSurveyByBoundingBox.search_node.
+        Returns (zoomable, median_leaf). Listings are saved on db_executor
+        (see search), not in the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            rectangle = self.get_rectangle_from_quadtree_node(quadtree_node, median_node)
+            price_band = self.get_price_band_from_quadtree_node(quadtree_node,
+                                                                median_node)
+            logger.info("Searching rectangle: zoom factor = %s, node = %s",
+                        len(quadtree_node), str(quadtree_node))
+            new_rooms = 0
+            zoomable = True
+            median_lists = {}
+            median_lists["latitude"] = []
+            median_lists["longitude"] = []
+            median_lists["price"] = []
+            items_offset = 0
+            room_count = 0
+            for section_offset in range(0, self.config.SEARCH_MAX_PAGES):
+                self.search_node_counter += 1
+                page_number = section_offset + 1
+                items_offset += room_count
+                room_count = 0
+                params = self.get_search_page_params(rectangle, room_type,
+                                                     section_offset, items_offset,
+                                                     price_band)
+                response = await fetcher.request_with_repeats(
+                    self.config.URL_API_SEARCH_ROOT, params)
+                if not response:
+                    logger.warning(
+                        "No response received from request despite multiple attempts: %s",
+                        params)
+                    if airbnb_ws.get_retry_budget(self.config).exhausted():
+                        raise airbnb_ws.ABRetryBudgetExhausted(
+                            "no page for {} and no retries left".format(quadtree_node))
+                    continue
+                json_listings_lists = self.get_listings_from_search_response(response)
+                if json_listings_lists is None:
+                    # not a search page: search no further in this node
+                    return (False, None)
+                (room_count, page_new_rooms) = await loop.run_in_executor(
+                    self.db_executor, self.save_search_page_listings,
+                    json_listings_lists, flag, median_lists)
+                new_rooms += page_new_rooms
+                logger.info("Node {node}: page {page_number:02d} returned "
+                            "{room_count:02d} listings"
+                            .format(node=quadtree_node, page_number=page_number,
+                                    room_count=room_count))
+                if room_count < self.config.SEARCH_LISTINGS_ON_FULL_PAGE:
+                    logger.info("Final page of listings for node %s", quadtree_node)
+                    zoomable = False
+                    break
+            return self.finish_search_node(quadtree_node, median_node, room_type,
+                                           page_number, room_count, new_rooms,
+                                           median_lists, zoomable,
+                                           log_progress=False)
+        except airbnb_ws.ABRetryBudgetExhausted:
+            raise
+        except Exception:
+            logger.exception("Exception in search_node_async")
+            raise
+
+
 class ABSurveyByNeighborhood(ABSurvey):
     """
     Subclass of Survey that carries out a survey by looping over
@@ -1033,7 +2043,7 @@ class ABSurveyByNeighborhood(ABSurvey):
             params["neighborhoods[]"] = neighborhood
             response = airbnb_ws.ws_request_with_repeats(self.config,
                                                          self.config.URL_API_SEARCH_ROOT,
-                                                         params)
+                                                         params, hedge=True)
             json_response = response.json()
             for result in json_response["results_json"]["search_results"]:
                 room_id = int(result["listing"]["id"])
@@ -1221,7 +2231,7 @@ class ABSurveyByZipcode(ABSurvey):
             params["room_types[]"] = room_type
             response = airbnb_ws.ws_request_with_repeats(self.config,
                                                          self.config.URL_API_SEARCH_ROOT,
-                                                         params)
+                                                         params, hedge=True)
             json_response = response.json()
             for result in json_response["results_json"]["search_results"]:
                 room_id = int(result["listing"]["id"])
@@ -7,31 +7,597 @@ Tom Slee, 2013--2017.
 """
 import logging
 import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import requests
+from requests.adapters import HTTPAdapter
+from airbnb_metrics import ABRequestMetrics, ABMetricsWriter
+import airbnb_codec
+
+try:
+    # brotli-compressed responses are decoded by urllib3 (and aiohttp)
+    # only if one of these is installed
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        import brotlicffi  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
 
 # Set up logging
 LOGGER = logging.getLogger()
 
+# HTTP status codes that indicate a proxy (or our own IP address) is being
+# turned away by the web site.
+BLOCKED_STATUS_CODES = (403, 429, 503)
+
+# A search page request is hedged when it runs past this quantile of the
+# recent latencies through its proxy
+HEDGE_QUANTILE = 0.95
+
+# Guards lazy creation of the per-config request helpers below
+_INIT_LOCK = threading.Lock()
+
+
+class ABRetryBudgetExhausted(Exception):
+    """
+    Raised when a page cannot be retrieved and the survey has no retries
+    left in its budget: the network is degraded, and the survey should
+    stop (to be resumed later) rather than carry on failing.
+    """
+
+
+class ABRequestNotMade(Exception):
+    """
+    Raised by a request attempt that never reaches the network, because
+    no proxy can be used before the request's deadline. It spends no
+    retry from the budget.
+    """
+
+
+class ABSessionPool():
+    """
+    A set of persistent HTTP sessions, one per proxy (or one for direct
+    requests), so that successive requests through the same proxy reuse
+    keep-alive connections rather than paying for a new TCP and TLS
+    handshake on every page.
+
+    A session is recycled (closed and replaced) after max_requests requests,
+    or when the web site appears to have blocked it.
+    """
+
+    def __init__(self, pool_maxsize=4, max_requests=1000):
+        self.pool_maxsize = pool_maxsize
+        self.max_requests = max_requests
+        # proxy -> [session, request_count]
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self, proxy):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_maxsize,
+                              max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if proxy:
+            session.proxies = {"http": proxy, "https": proxy}
+        LOGGER.debug("New HTTP session for proxy %s", proxy)
+        return session
+
+    def get(self, proxy):
+        """
+        Return the session for proxy (None for a direct connection),
+        creating or recycling it as needed.
+        """
+        with self._lock:
+            entry = self._sessions.get(proxy)
+            if entry is not None and 0 < self.max_requests <= entry[1]:
+                LOGGER.debug("Recycling HTTP session for proxy %s after %s requests",
+                             proxy, entry[1])
+                entry[0].close()
+                entry = None
+            if entry is None:
+                entry = [self._new_session(proxy), 0]
+                self._sessions[proxy] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def recycle(self, proxy):
+        """
+        Close and forget the session for proxy, so that the next request
+        through it starts with fresh connections and cookies.
+        """
+        with self._lock:
+            entry = self._sessions.pop(proxy, None)
+        if entry is not None:
+            LOGGER.debug("Discarding HTTP session for proxy %s", proxy)
+            entry[0].close()
+
+    def close(self):
+        """ Close all sessions """
+        with self._lock:
+            entries = list(self._sessions.values())
+            self._sessions = {}
+        for entry in entries:
+            entry[0].close()
+
+
+class ABResponse():
+    """
+    A minimal stand-in for requests.Response, for pages that do not come
+    from a requests session (for example, from the asyncio engine in
+    airbnb_ws_async). It has the attributes that the survey and listing
+    code use.
+    """
+
+    def __init__(self, status_code, content, encoding=None, url=None,
+                 headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.url = url
+        self.headers = headers or {}
+
+    def __bool__(self):
+        # as for requests.Response, true for any non-error status
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", "replace")
+
+    def json(self):
+        return airbnb_codec.loads(self.content)
+
+
+class ABRateController():
+    """
+    Paces requests separately for each proxy, using additive increase /
+    multiplicative decrease (AIMD): each successful request raises the
+    proxy's rate by `increase` requests per second, up to max_rate, and each
+    request the web site refuses (403, 429 or 503) multiplies it by
+    `decrease`, down to min_rate. A proxy that is being turned away slows
+    down by itself, without holding back the others.
+    """
+
+    def __init__(self, initial_rate=1.0, min_rate=0.05, max_rate=5.0,
+                 increase=0.1, decrease=0.5):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        # proxy -> [rate (requests/second), time the next request may start]
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def _get_state(self, proxy):
+        state = self._state.get(proxy)
+        if state is None:
+            state = [self.initial_rate, 0.0]
+            self._state[proxy] = state
+        return state
+
+    def acquire(self, proxies):
+        """
+        Choose the proxy from proxies (a list, which may be [None] for
+        direct requests) that can be used soonest, and reserve its next
+        request slot. Returns (proxy, seconds to wait before the request).
+        """
+        with self._lock:
+            now = time.monotonic()
+            states = [(max(self._get_state(proxy)[1], now), proxy)
+                      for proxy in proxies]
+            earliest = min(start for (start, proxy) in states)
+            proxy = random.choice([proxy for (start, proxy) in states
+                                   if start == earliest])
+            state = self._get_state(proxy)
+            state[1] = earliest + 1.0 / state[0]
+            return (proxy, earliest - now)
+
+    def success(self, proxy):
+        """ Additive increase after a successful request """
+        with self._lock:
+            state = self._get_state(proxy)
+            state[0] = min(self.max_rate, state[0] + self.increase)
+
+    def throttled(self, proxy):
+        """ Multiplicative decrease after a refused request """
+        with self._lock:
+            state = self._get_state(proxy)
+            state[0] = max(self.min_rate, state[0] * self.decrease)
+            state[1] = max(state[1], time.monotonic() + 1.0 / state[0])
+            LOGGER.info("Request rate for proxy %s reduced to %.3f per second",
+                        proxy, state[0])
+
+    def rate(self, proxy):
+        """ The current request rate (per second) for proxy """
+        with self._lock:
+            return self._get_state(proxy)[0]
 
-def ws_request_with_repeats(config, url, params=None):
+
+class ABProxyRegistry():
+    """
+    Tracks the health of each proxy. A proxy that is refused by the web
+    site, or that fails to connect, goes into quarantine for a time that
+    doubles with each consecutive failure (from base_quarantine seconds up
+    to max_quarantine), and comes back automatically when the time is up.
+    Requests carry on through the proxies that remain healthy.
+
+    With no proxies, the registry tracks the direct connection (None),
+    which is quarantined only when the web site refuses it (see
+    ws_handle_connection_error).
+    """
+
+    def __init__(self, proxies, base_quarantine=60.0, max_quarantine=3600.0):
+        self.proxies = list(proxies) if proxies else [None]
+        self.base_quarantine = base_quarantine
+        self.max_quarantine = max_quarantine
+        # proxy -> number of consecutive failures
+        self._failures = {}
+        # proxy -> time (time.monotonic()) at which it leaves quarantine
+        self._release = {}
+        self._lock = threading.Lock()
+
+    def healthy(self):
+        """
+        Return the proxies that are not in quarantine, first returning any
+        whose quarantine has expired.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for proxy, release in list(self._release.items()):
+                if release <= now:
+                    del self._release[proxy]
+                    LOGGER.info("Proxy %s returned from quarantine; %s of %s healthy",
+                                proxy, len(self.proxies) - len(self._release),
+                                len(self.proxies))
+            return [proxy for proxy in self.proxies
+                    if proxy not in self._release]
+
+    def next_release(self):
+        """
+        Return (proxy, seconds) for the quarantined proxy that will be
+        released soonest.
+        """
+        with self._lock:
+            now = time.monotonic()
+            (release, proxy) = min((release, proxy) for (proxy, release)
+                                   in self._release.items())
+            return (proxy, max(0.0, release - now))
+
+    def quarantine(self, proxy):
+        """ Put a failing proxy into quarantine, with exponential backoff """
+        with self._lock:
+            failures = self._failures.get(proxy, 0) + 1
+            self._failures[proxy] = failures
+            duration = min(self.max_quarantine,
+                           self.base_quarantine * 2 ** (failures - 1))
+            self._release[proxy] = time.monotonic() + duration
+            LOGGER.warning(
+                "Proxy %s quarantined for %.0f seconds (failure %s); %s of %s healthy",
+                proxy, duration, failures,
+                len(self.proxies) - len(self._release), len(self.proxies))
+
+    def success(self, proxy):
+        """ A successful request resets the proxy's backoff """
+        with self._lock:
+            if self._failures.pop(proxy, None) is not None:
+                LOGGER.debug("Proxy %s is healthy again", proxy)
+
+
+class ABHedger():
+    """
+    Runs hedged requests: the threads that carry the duplicate requests,
+    and the cap on how many are sent. At most hedge_rate hedges are sent
+    per request made through ws_hedged_request.
+    """
+
+    def __init__(self, hedge_rate=0.05, max_workers=8):
+        self.hedge_rate = hedge_rate
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="hedge")
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def allow(self):
+        """ Reserve a hedge if that keeps within the cap """
+        with self._lock:
+            if self.hedges + 1 > self.hedge_rate * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+
+class ABRetryBudget():
+    """
+    A retry budget shared by all the requests made with one configuration
+    (that is, by one survey). Each page requested earns `ratio` retries,
+    and each retry spends one; the balance starts at, and is capped at,
+    `maximum`. When the budget is empty failed requests are not retried,
+    so a degraded network sheds retries rather than multiplying the load.
+    """
+
+    def __init__(self, ratio=0.2, maximum=100.0):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.balance = maximum
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """ A new page request earns part of a retry """
+        with self._lock:
+            self.balance = min(self.maximum, self.balance + self.ratio)
+            return self.balance
+
+    def refund(self):
+        """ Give back a retry that was not used to make a request """
+        with self._lock:
+            self.balance = min(self.maximum, self.balance + 1.0)
+            return self.balance
+
+    def withdraw(self):
+        """ Spend a retry: returns False if there is none to spend """
+        with self._lock:
+            if self.balance < 1.0:
+                return False
+            self.balance -= 1.0
+            return True
+
+    def exhausted(self):
+        """ True if there is no retry left to spend """
+        with self._lock:
+            return self.balance < 1.0
+
+
+def get_session_pool(config):
+    """
+    Return the session pool for this configuration, creating it on first
+    use. The pool is kept on the config object, as the database
+    connection is.
+    """
+    pool = getattr(config, "session_pool", None)
+    if pool is None:
+        with _INIT_LOCK:
+            pool = getattr(config, "session_pool", None)
+            if pool is None:
+                pool = ABSessionPool(config.HTTP_POOL_MAXSIZE,
+                                     config.HTTP_SESSION_MAX_REQUESTS)
+                config.session_pool = pool
+    return pool
+
+
+def get_rate_controller(config):
+    """
+    Return the per-proxy rate controller for this configuration, creating
+    it on first use.
+    """
+    controller = getattr(config, "rate_controller", None)
+    if controller is None:
+        with _INIT_LOCK:
+            controller = getattr(config, "rate_controller", None)
+            if controller is None:
+                controller = ABRateController(
+                    config.RATE_INITIAL, config.RATE_MIN, config.RATE_MAX,
+                    config.RATE_INCREASE, config.RATE_DECREASE)
+                config.rate_controller = controller
+    return controller
+
+
+def get_proxy_registry(config):
+    """
+    Return the proxy health registry for this configuration, creating it
+    on first use from the complete proxy list.
+    """
+    registry = getattr(config, "proxy_registry", None)
+    if registry is None:
+        with _INIT_LOCK:
+            registry = getattr(config, "proxy_registry", None)
+            if registry is None:
+                registry = ABProxyRegistry(config.HTTP_PROXY_LIST_COMPLETE,
+                                           config.RE_INIT_SLEEP_TIME,
+                                           config.PROXY_QUARANTINE_MAX)
+                config.proxy_registry = registry
+    return registry
+
+
+def get_retry_budget(config):
+    """
+    Return the retry budget for this configuration, creating it on first
+    use.
+    """
+    budget = getattr(config, "retry_budget", None)
+    if budget is None:
+        with _INIT_LOCK:
+            budget = getattr(config, "retry_budget", None)
+            if budget is None:
+                budget = ABRetryBudget(config.RETRY_BUDGET_RATIO,
+                                       config.RETRY_BUDGET_MAX)
+                config.retry_budget = budget
+    return budget
+
+
+def get_hedger(config):
+    """
+    Return the hedged request runner for this configuration, or None if
+    hedge_rate is zero.
+    """
+    if config.HEDGE_RATE <= 0:
+        return None
+    hedger = getattr(config, "hedger", None)
+    if hedger is None:
+        with _INIT_LOCK:
+            hedger = getattr(config, "hedger", None)
+            if hedger is None:
+                # every page in flight (one per search worker, and the
+                # pages each prefetches) may hold two threads: the
+                # original and the duplicate
+                pages_in_flight = (max(1, config.SEARCH_WORKERS)
+                                   * (1 + config.SEARCH_PREFETCH_PAGES))
+                hedger = ABHedger(config.HEDGE_RATE, max(
+                    8, 2 * pages_in_flight,
+                    2 * len(config.HTTP_PROXY_LIST_COMPLETE)))
+                config.hedger = hedger
+    return hedger
+
+
+def get_response_cache(config):
+    """
+    Return the on-disk response cache for this configuration, or None if
+    no cache_dir is configured.
+    """
+    if not config.CACHE_DIR:
+        return None
+    cache = getattr(config, "response_cache", None)
+    if cache is None:
+        with _INIT_LOCK:
+            cache = getattr(config, "response_cache", None)
+            if cache is None:
+                # imported here, as airbnb_cache uses ABResponse from this module
+                from airbnb_cache import ABResponseCache
+                cache = ABResponseCache(config.CACHE_DIR, config.CACHE_TTL,
+                                        config.CACHE_MAX_SIZE)
+                config.response_cache = cache
+    return cache
+
+
+def get_metrics(config):
+    """
+    Return the request metrics for this configuration. If metrics_file is
+    configured, the first call also starts writing snapshots to it.
+    """
+    metrics = getattr(config, "request_metrics", None)
+    if metrics is None:
+        with _INIT_LOCK:
+            metrics = getattr(config, "request_metrics", None)
+            if metrics is None:
+                metrics = ABRequestMetrics()
+                if config.METRICS_FILE:
+                    config.metrics_writer = ABMetricsWriter(
+                        metrics, config.METRICS_FILE, config.METRICS_FORMAT,
+                        config.METRICS_INTERVAL)
+                config.request_metrics = metrics
+    return metrics
+
+
+def get_recorder(config):
+    """
+    Return the response recorder for this configuration, or None if no
+    record_dir is configured.
+    """
+    if not config.RECORD_DIR:
+        return None
+    recorder = getattr(config, "recorder", None)
+    if recorder is None:
+        with _INIT_LOCK:
+            recorder = getattr(config, "recorder", None)
+            if recorder is None:
+                from airbnb_replay import ABRecorder
+                recorder = ABRecorder(config.RECORD_DIR)
+                config.recorder = recorder
+    return recorder
+
+
+def ws_cached_response(config, url, params=None):
+    """
+    Return the page from the response cache, or None if there is no cache
+    or the page is not in it.
+    """
+    response_cache = get_response_cache(config)
+    if response_cache is None:
+        return None
+    return response_cache.get(url, params, config.CACHE_SCOPE)
+
+
+def ws_store_response(config, url, params, response):
+    """
+    Keep a successful response: add it to the response cache and the
+    recording, if either is configured.
+    """
+    response_cache = get_response_cache(config)
+    if response_cache is not None:
+        response_cache.put(url, params, response, config.CACHE_SCOPE)
+    recorder = get_recorder(config)
+    if recorder is not None:
+        recorder.record(url, params, response)
+
+
+def ws_request_with_repeats(config, url, params=None, hedge=False):
     """ An attempt to get data from Airbnb. The function wraps
     a number of individual attempts, each of which may fail
     occasionally, in an attempt to get a more reliable
     data set.
 
+    If hedge is True (for search pages), each attempt is made through
+    ws_hedged_request.
+
+    Attempts stop early when the request deadline (request_deadline
+    seconds from the first attempt) passes, or when the survey's retry
+    budget is empty. If every proxy (or the direct connection) is in
+    quarantine, the next attempt waits for one to come back: the wait
+    does not count against the deadline, and an attempt that does not
+    reach the network does not spend a retry.
+
+    If a response cache is configured, pages are read from it when
+    present, and successful responses are added to it (and to the
+    recording, if one is configured).
+
     Returns None on failure
     """
     LOGGER.debug("URL for this search: %s", url)
+    # Pages that have already been downloaded are read from the cache
+    metrics = get_metrics(config)
+    response = ws_cached_response(config, url, params)
+    if response is not None:
+        metrics.cache_hit(url)
+        return response
+    # Draw sessions from the pool, so connections are kept alive between
+    # requests through the same proxy
+    session_pool = get_session_pool(config)
+    deadline = ws_start_request(config)
+    # the proxy of the last attempt, which retries are counted against
+    http_proxy = None
     for attempt_id in range(config.MAX_CONNECTION_ATTEMPTS):
+        quarantine_wait = ws_quarantine_wait(config)
+        if quarantine_wait > 0:
+            time.sleep(quarantine_wait)
+            if deadline is not None:
+                deadline += quarantine_wait
+        if attempt_id > 0 and not ws_may_retry(config, url, http_proxy,
+                                               attempt_id, deadline):
+            break
         try:
-            response = ws_individual_request(config, url, attempt_id, params)
+            proxy_choice = ws_choose_proxy(config)
+            http_proxy = proxy_choice[0]
+            if hedge:
+                response = ws_hedged_request(config, url, attempt_id, params,
+                                             session_pool, deadline,
+                                             proxy_choice)
+            else:
+                response = ws_individual_request(config, url, attempt_id,
+                                                 params, session_pool,
+                                                 proxy_choice, deadline)
             if response is None:
                 continue
             elif response.status_code == requests.codes.ok:
+                ws_store_response(config, url, params, response)
                 return response
         except (SystemExit, KeyboardInterrupt):
             raise
+        except ABRequestNotMade:
+            # the deadline has passed: the page fails, but without
+            # spending a retry on a request that was never made
+            if attempt_id > 0:
+                get_retry_budget(config).refund()
+            break
         except AttributeError:
             LOGGER.exception("AttributeError retrieving page")
         except Exception as ex:
@@ -41,82 +607,186 @@ def ws_request_with_repeats(config, url, params=None):
     return None
 
 
-def ws_individual_request(config, url, attempt_id, params=None):
+def ws_start_request(config):
+    """
+    Bookkeeping at the start of a page request: add to the retry budget,
+    and return the request's deadline (a time.monotonic() value, or None
+    if request_deadline is not set).
+    """
+    get_metrics(config).gauge("retry_budget", get_retry_budget(config).deposit())
+    if config.REQUEST_DEADLINE > 0:
+        return time.monotonic() + config.REQUEST_DEADLINE
+    return None
+
+
+def ws_quarantine_wait(config):
     """
-    Individual web request: returns a response object or None on failure
+    Seconds until a proxy (or the direct connection) comes out of
+    quarantine, if all are in quarantine; otherwise 0.
     """
+    registry = get_proxy_registry(config)
+    if registry.healthy():
+        return 0.0
+    (proxy, quarantine_wait) = registry.next_release()
+    LOGGER.warning("All %s proxies are in quarantine: waiting %.0f seconds for %s",
+                   len(registry.proxies), quarantine_wait, proxy)
+    return quarantine_wait
+
+
+def ws_may_retry(config, url, http_proxy, attempt_id, deadline):
+    """
+    Decide whether a failed page request gets another attempt: not if its
+    deadline has passed, or if the retry budget is empty. http_proxy is
+    the proxy of the failed attempt, for the metrics.
+    """
+    metrics = get_metrics(config)
+    budget = get_retry_budget(config)
+    if deadline is not None and time.monotonic() >= deadline:
+        LOGGER.warning("Request deadline of %s seconds passed after %s attempts: %s",
+                       config.REQUEST_DEADLINE, attempt_id, url)
+        metrics.deadline_exceeded(http_proxy, url)
+        return False
+    if not budget.withdraw():
+        LOGGER.warning("Retry budget exhausted: not retrying %s", url)
+        metrics.retry_shed(http_proxy, url)
+        return False
+    metrics.retry(http_proxy, url)
+    metrics.gauge("retry_budget", budget.balance)
+    if deadline is None:
+        LOGGER.info("Retrying (attempt %s): %.1f retries left in budget",
+                    attempt_id + 1, budget.balance)
+    else:
+        LOGGER.info("Retrying (attempt %s): %.1f retries left in budget, "
+                    "%.1f seconds to deadline", attempt_id + 1, budget.balance,
+                    deadline - time.monotonic())
+    return True
+
+
+def ws_hedged_request(config, url, attempt_id, params=None,
+                      session_pool=None, deadline=None, proxy_choice=None):
+    """
+    Individual web request with a hedge: if the request runs past the p95
+    latency observed for its proxy, send a duplicate through a second
+    healthy proxy and use whichever answers first. Hedges are capped at
+    hedge_rate of requests. The slower request is left to finish in the
+    background, as requests cannot be cancelled. proxy_choice, if given,
+    is the (proxy, wait) from ws_choose_proxy for the first request.
+
+    Returns a response object or None on failure
+    """
+    hedger = get_hedger(config)
+    if hedger is None:
+        return ws_individual_request(config, url, attempt_id, params,
+                                     session_pool, proxy_choice, deadline)
+    hedger.count_request()
+    metrics = get_metrics(config)
+    first_choice = proxy_choice
+    if first_choice is None:
+        first_choice = ws_choose_proxy(config)
+    hedge_delay = metrics.latency_quantile(first_choice[0], url, HEDGE_QUANTILE)
+    if hedge_delay is None:
+        # too few requests through this proxy to know what is slow
+        return ws_individual_request(config, url, attempt_id, params,
+                                     session_pool, first_choice, deadline)
+    started = threading.Event()
+    futures = [hedger.executor.submit(ws_started_request, started, config,
+                                      url, attempt_id, params, session_pool,
+                                      first_choice, deadline)]
+    # the hedge delay runs from when the request starts, not from when it
+    # is queued for a thread
+    started.wait()
+    (done, pending) = wait(futures, timeout=first_choice[1] + hedge_delay)
+    if pending and hedger.allow():
+        second_choice = ws_choose_proxy(config, exclude=[first_choice[0]])
+        if second_choice is not None:
+            LOGGER.info("Request through proxy %s is slower than %.2f seconds: "
+                        "hedging through proxy %s",
+                        first_choice[0], hedge_delay, second_choice[0])
+            futures.append(hedger.executor.submit(
+                ws_individual_request, config, url, attempt_id, params,
+                session_pool, second_choice, deadline))
+    # Take the first page to arrive; failing that, the last failure
+    response = None
+    winner = None
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except ABRequestNotMade:
+            if future is futures[0]:
+                raise
+            # a hedge that could not be sent in time
+            continue
+        if result is not None:
+            response = result
+            if result.status_code == requests.codes.ok:
+                winner = futures.index(future)
+                break
+    if len(futures) > 1:
+        metrics.hedge(url, won=(winner == 1))
+    return response
+
+
+def ws_started_request(started, *args):
+    """ ws_individual_request(*args), setting the started event first """
+    started.set()
+    return ws_individual_request(*args)
+
+
+def ws_individual_request(config, url, attempt_id, params=None,
+                          session_pool=None, proxy_choice=None, deadline=None):
+    """
+    Individual web request: returns a response object or None on failure.
+    proxy_choice, if given, is the (proxy, wait) from ws_choose_proxy.
+    deadline, if given, is a time.monotonic() value: the request is not
+    made if it would have to start after the deadline, and its timeout is
+    cut short to end by it.
+    """
+    http_proxy = None
+    if session_pool is None:
+        session_pool = get_session_pool(config)
+    metrics = get_metrics(config)
+    start_time = time.monotonic()
     try:
-        # wait
-        sleep_time = config.REQUEST_SLEEP * random.random()
+        # wait until the chosen proxy may be used again
+        if proxy_choice is None:
+            proxy_choice = ws_choose_proxy(config)
+        (http_proxy, sleep_time) = proxy_choice
         LOGGER.debug("sleeping " + str(sleep_time)[:7] + " seconds...")
+        timeout = config.HTTP_TIMEOUT
+        if deadline is not None:
+            remaining = deadline - time.monotonic() - sleep_time
+            if remaining <= 0:
+                LOGGER.warning("Network request %s: proxy %s not available before the deadline",
+                               attempt_id, http_proxy)
+                metrics.deadline_exceeded(http_proxy, url)
+                raise ABRequestNotMade(url)
+            timeout = min(timeout, remaining)
         time.sleep(sleep_time)  # be nice
+        metrics.wait(http_proxy, url, sleep_time)
+        start_time = time.monotonic()
 
-        timeout = config.HTTP_TIMEOUT
+        headers = ws_request_headers(config)
 
-        # If a list of user agent strings is supplied, use it
-        if len(config.USER_AGENT_LIST) > 0:
-            user_agent = random.choice(config.USER_AGENT_LIST)
-            headers = {"User-Agent": user_agent}
-        else:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-
-        # If there is a list of proxies supplied, use it
-        http_proxy = None
-        LOGGER.debug("Using " + str(len(config.HTTP_PROXY_LIST)) + " proxies")
-        if len(config.HTTP_PROXY_LIST) > 0:
-            http_proxy = random.choice(config.HTTP_PROXY_LIST)
-            proxies = {
-                'http': http_proxy,
-                'https': http_proxy,
-            }
-            LOGGER.debug("Requesting page through proxy %s", http_proxy)
-        else:
-            proxies = None
-            LOGGER.debug("Requesting page without using a proxy")
-
-        # Now make the request
+        # Now make the request, through the pooled session for this proxy
         # cookie to avoid auto-redirect
         cookies = dict(sticky_locale='en')
-        response = requests.get(url, params, timeout=timeout,
-                                headers=headers, cookies=cookies, proxies=proxies)
+        session = session_pool.get(http_proxy)
+        response = session.get(url, params=params, timeout=timeout,
+                               headers=headers, cookies=cookies)
+        metrics.observe(http_proxy, url, response.status_code,
+                        time.monotonic() - start_time, len(response.content))
         if response.status_code < 300:
+            get_rate_controller(config).success(http_proxy)
+            get_proxy_registry(config).success(http_proxy)
             return response
         else:
-            if http_proxy:
-                LOGGER.warning(
-                    "HTTP status %s from web site: IP address %s may be blocked",
-                    response.status_code, http_proxy)
-                if len(config.HTTP_PROXY_LIST) > 0:
-                    # randomly remove the proxy from the list, with probability 50%
-                    if random.choice([True, False]):
-                        config.HTTP_PROXY_LIST.remove(http_proxy)
-                        LOGGER.warning(
-                            "Removing %s from proxy list; %s of %s remain",
-                            http_proxy, len(config.HTTP_PROXY_LIST),
-                            len(config.HTTP_PROXY_LIST_COMPLETE))
-                    else:
-                        LOGGER.warning(
-                            "Not removing %s from proxy list this time; still %s of %s",
-                            http_proxy, len(config.HTTP_PROXY_LIST),
-                            len(config.HTTP_PROXY_LIST_COMPLETE))
-                if len(config.HTTP_PROXY_LIST) == 0:
-                    # fill proxy list again, wait a long time, then restart
-                    LOGGER.warning(("No proxies remain."
-                                    "Resetting proxy list and waiting %s minutes."),
-                                   (config.RE_INIT_SLEEP_TIME / 60.0))
-                    config.HTTP_PROXY_LIST = list(config.HTTP_PROXY_LIST_COMPLETE)
-                    time.sleep(config.RE_INIT_SLEEP_TIME)
-                    config.REQUEST_SLEEP += 1.0
-                    LOGGER.warning("Adding one second to request sleep time.  Now %s",
-                                   config.REQUEST_SLEEP)
-            else:
-                LOGGER.warning(("HTTP status %s from web site: IP address blocked. "
-                                "Waiting %s minutes."),
-                               response.status_code, (config.RE_INIT_SLEEP_TIME / 60.0))
-                time.sleep(config.RE_INIT_SLEEP_TIME)
-                config.REQUEST_SLEEP += 1.0
+            if response.status_code in BLOCKED_STATUS_CODES:
+                # Start again with fresh connections and cookies
+                session_pool.recycle(http_proxy)
+            ws_handle_refused_request(config, http_proxy,
+                                      response.status_code)
             return response
-    except (SystemExit, KeyboardInterrupt):
+    except (SystemExit, KeyboardInterrupt, ABRequestNotMade):
         raise
     except requests.exceptions.ConnectionError:
         # For requests error and exceptions, see
@@ -124,23 +794,111 @@ def ws_individual_request(config, url, attempt_id, params=None):
         # errors-and-exceptions
         LOGGER.warning("Network request %s: connectionError. Bad proxy %s?",
                        attempt_id, http_proxy)
+        metrics.error(http_proxy, url, "connection",
+                      time.monotonic() - start_time)
+        # The pooled connections may be broken: do not reuse them
+        session_pool.recycle(http_proxy)
+        ws_handle_connection_error(config, http_proxy)
         return None
     except requests.exceptions.HTTPError:
         LOGGER.error(
             "Network request exception %s (invalid HTTP response), for proxy %s",
             attempt_id, http_proxy)
+        metrics.error(http_proxy, url, "http", time.monotonic() - start_time)
         return None
     except requests.exceptions.Timeout:
         LOGGER.warning(
             "Network request exception %s (timeout), for proxy %s",
             attempt_id, http_proxy)
+        metrics.timeout(http_proxy, url, time.monotonic() - start_time)
         return None
     except requests.exceptions.TooManyRedirects:
         LOGGER.error("Network request exception %s: too many redirects", attempt_id)
+        metrics.error(http_proxy, url, "redirects", time.monotonic() - start_time)
         return None
     except requests.exceptions.RequestException:
         LOGGER.error("Network request exception %s: unidentified requests", attempt_id)
+        metrics.error(http_proxy, url, "request", time.monotonic() - start_time)
         return None
     except Exception as e:
         LOGGER.exception("Network request exception: type %s", type(e).__name__)
         return None
+
+
+def ws_request_headers(config):
+    """
+    Headers for a request: if a list of user agent strings is supplied,
+    use one at random. Compressed responses are accepted (and decompressed
+    by the HTTP library).
+    """
+    if len(config.USER_AGENT_LIST) > 0:
+        user_agent = random.choice(config.USER_AGENT_LIST)
+        headers = {"User-Agent": user_agent}
+    else:
+        headers = {'User-Agent': 'Mozilla/5.0'}
+    headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return headers
+
+
+def ws_choose_proxy(config, exclude=None):
+    """
+    Pick the healthy proxy that the rate controller can use soonest.
+    Returns (http_proxy, seconds to wait before using it); http_proxy is
+    None if requests go directly to the web site.
+    If every proxy is in quarantine, the wait is until the first one
+    comes back.
+    If exclude (a list of proxies) is given, only other healthy proxies
+    are considered, and None is returned if there are none.
+    """
+    registry = get_proxy_registry(config)
+    proxies = registry.healthy()
+    quarantine_wait = 0
+    if exclude is not None:
+        proxies = [proxy for proxy in proxies if proxy not in exclude]
+        if not proxies:
+            return None
+    elif not proxies:
+        (proxy, quarantine_wait) = registry.next_release()
+        LOGGER.warning("All %s proxies are in quarantine: waiting %.0f seconds for %s",
+                       len(registry.proxies), quarantine_wait, proxy)
+        proxies = [proxy]
+    LOGGER.debug("Using " + str(len(proxies)) + " proxies")
+    (http_proxy, wait_time) = get_rate_controller(config).acquire(proxies)
+    if http_proxy:
+        LOGGER.debug("Requesting page through proxy %s", http_proxy)
+    else:
+        LOGGER.debug("Requesting page without using a proxy")
+    return (http_proxy, max(wait_time, quarantine_wait))
+
+
+def ws_handle_connection_error(config, http_proxy):
+    """
+    Bookkeeping after a request fails to connect. A proxy goes into
+    quarantine, so that later requests go through the others. With no
+    proxies the direct connection is not quarantined, as there is nothing
+    else to use: it is slowed down, and the request is retried.
+    Shared by the blocking and asyncio request paths.
+    """
+    if http_proxy is None:
+        get_rate_controller(config).throttled(http_proxy)
+    else:
+        get_proxy_registry(config).quarantine(http_proxy)
+
+
+def ws_handle_refused_request(config, http_proxy, status_code):
+    """
+    Bookkeeping after the web site returns a non-2xx status. If the proxy
+    (or, with no proxies, our own IP address) appears to be blocked, slow
+    it down and put it into quarantine: later requests go through the
+    remaining healthy proxies, and it returns once its quarantine expires.
+    Shared by the blocking and asyncio request paths.
+    """
+    if status_code in BLOCKED_STATUS_CODES:
+        LOGGER.warning(
+            "HTTP status %s from web site: IP address %s may be blocked",
+            status_code, http_proxy if http_proxy else "(no proxy)")
+        get_rate_controller(config).throttled(http_proxy)
+        get_proxy_registry(config).quarantine(http_proxy)
+    else:
+        LOGGER.warning("HTTP status %s from web site, for proxy %s",
+                       status_code, http_proxy)
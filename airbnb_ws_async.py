@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+"""
+An asyncio engine for requesting pages from the Airbnb web site, so that
+a survey can keep several requests in flight at once instead of waiting
+on each one in turn.
+
+The retry and proxy handling follows ws_request_with_repeats in
+airbnb_ws, and shares its helper functions. Requires the aiohttp package.
+"""
+import asyncio
+import logging
+import sys
+import time
+import airbnb_ws
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+
+class ABAsyncFetcher():
+    """
+    Fetch pages concurrently, with at most `concurrency` requests in flight.
+    Use as an async context manager so the underlying HTTP session (and its
+    keep-alive connections) is closed at the end:
+
+        async with ABAsyncFetcher(config) as fetcher:
+            response = await fetcher.request_with_repeats(url, params)
+    """
+
+    def __init__(self, config, concurrency=None):
+        if aiohttp is None:
+            LOGGER.error("The aiohttp package is needed for asynchronous "
+                         "searches: install it, or use -sb instead.")
+            sys.exit()
+        self.config = config
+        if concurrency is None:
+            concurrency = config.ASYNC_CONCURRENCY
+        self.concurrency = max(1, concurrency)
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        # cookie to avoid auto-redirect
+        self._session = aiohttp.ClientSession(
+            connector=connector, cookies=dict(sticky_locale='en'))
+        return self
+
+    async def __aexit__(self, *args):
+        await self._session.close()
+
+    async def request_with_repeats(self, url, params=None):
+        """
+        Asynchronous counterpart of airbnb_ws.ws_request_with_repeats.
+        Returns an airbnb_ws.ABResponse, or None on failure.
+        """
+        LOGGER.debug("URL for this search: %s", url)
+        metrics = airbnb_ws.get_metrics(self.config)
+        response = airbnb_ws.ws_cached_response(self.config, url, params)
+        if response is not None:
+            metrics.cache_hit(url)
+            return response
+        deadline = airbnb_ws.ws_start_request(self.config)
+        # the proxy of the last attempt, which retries are counted against
+        http_proxy = None
+        for attempt_id in range(self.config.MAX_CONNECTION_ATTEMPTS):
+            # as in ws_request_with_repeats, waiting for a proxy to leave
+            # quarantine does not count against the deadline
+            quarantine_wait = airbnb_ws.ws_quarantine_wait(self.config)
+            if quarantine_wait > 0:
+                await asyncio.sleep(quarantine_wait)
+                if deadline is not None:
+                    deadline += quarantine_wait
+            if attempt_id > 0 and not airbnb_ws.ws_may_retry(
+                    self.config, url, http_proxy, attempt_id, deadline):
+                break
+            try:
+                proxy_choice = airbnb_ws.ws_choose_proxy(self.config)
+                http_proxy = proxy_choice[0]
+                response = await self.individual_request(url, attempt_id, params,
+                                                         deadline, proxy_choice)
+                if response is None:
+                    continue
+                elif response.status_code == 200:
+                    airbnb_ws.ws_store_response(self.config, url, params, response)
+                    return response
+            except (SystemExit, KeyboardInterrupt, asyncio.CancelledError):
+                raise
+            except airbnb_ws.ABRequestNotMade:
+                if attempt_id > 0:
+                    airbnb_ws.get_retry_budget(self.config).refund()
+                break
+            except Exception as ex:
+                LOGGER.error("Failed to retrieve web page %s", url)
+                LOGGER.exception("Exception retrieving page: %s", str(type(ex)))
+        return None
+
+    async def individual_request(self, url, attempt_id, params=None,
+                                 deadline=None, proxy_choice=None):
+        """
+        Individual web request: returns an ABResponse or None on failure.
+        The request is cut short at deadline (a time.monotonic() value),
+        if one is given. proxy_choice, if given, is the (proxy, wait) from
+        airbnb_ws.ws_choose_proxy.
+        """
+        config = self.config
+        http_proxy = None
+        metrics = airbnb_ws.get_metrics(config)
+        start_time = time.monotonic()
+        try:
+            # wait until the chosen proxy may be used again, without
+            # holding up other requests
+            if proxy_choice is None:
+                proxy_choice = airbnb_ws.ws_choose_proxy(config)
+            (http_proxy, sleep_time) = proxy_choice
+            LOGGER.debug("sleeping " + str(sleep_time)[:7] + " seconds...")
+            await asyncio.sleep(sleep_time)  # be nice
+            metrics.wait(http_proxy, url, sleep_time)
+
+            headers = airbnb_ws.ws_request_headers(config)
+            async with self._semaphore:
+                start_time = time.monotonic()
+                timeout = config.HTTP_TIMEOUT
+                if deadline is not None:
+                    timeout = min(timeout, deadline - start_time)
+                    if timeout <= 0:
+                        LOGGER.warning("Network request %s: deadline passed before the request",
+                                       attempt_id)
+                        metrics.deadline_exceeded(http_proxy, url)
+                        raise airbnb_ws.ABRequestNotMade(url)
+                timeout = aiohttp.ClientTimeout(total=timeout)
+                async with self._session.get(
+                        url, params=_query_params(params), headers=headers,
+                        proxy=_proxy_url(http_proxy),
+                        timeout=timeout) as http_response:
+                    content = await http_response.read()
+                    response = airbnb_ws.ABResponse(
+                        http_response.status, content,
+                        http_response.charset, str(http_response.url),
+                        dict(http_response.headers))
+            metrics.observe(http_proxy, url, response.status_code,
+                            time.monotonic() - start_time, len(content))
+            if response.status_code < 300:
+                airbnb_ws.get_rate_controller(config).success(http_proxy)
+                airbnb_ws.get_proxy_registry(config).success(http_proxy)
+                return response
+            airbnb_ws.ws_handle_refused_request(
+                config, http_proxy, response.status_code)
+            return response
+        except (SystemExit, KeyboardInterrupt, asyncio.CancelledError,
+                airbnb_ws.ABRequestNotMade):
+            raise
+        except asyncio.TimeoutError:
+            LOGGER.warning(
+                "Network request exception %s (timeout), for proxy %s",
+                attempt_id, http_proxy)
+            metrics.timeout(http_proxy, url, time.monotonic() - start_time)
+            return None
+        except aiohttp.ClientConnectionError:
+            LOGGER.warning("Network request %s: connectionError. Bad proxy %s?",
+                           attempt_id, http_proxy)
+            metrics.error(http_proxy, url, "connection",
+                          time.monotonic() - start_time)
+            airbnb_ws.ws_handle_connection_error(config, http_proxy)
+            return None
+        except aiohttp.ClientError:
+            LOGGER.error("Network request exception %s: unidentified request error",
+                         attempt_id)
+            metrics.error(http_proxy, url, "request",
+                          time.monotonic() - start_time)
+            return None
+        except Exception as e:
+            LOGGER.exception("Network request exception: type %s", type(e).__name__)
+            return None
+
+
+def _query_params(params):
+    """
+    aiohttp rejects None values in a query, where requests drops them.
+    """
+    if params is None:
+        return None
+    return {key: str(value) for key, value in params.items()
+            if value is not None}
+
+
+def _proxy_url(http_proxy):
+    """
+    aiohttp needs a scheme on the proxy; the proxy_list entries in the
+    config file are often bare host:port pairs.
+    """
+    if not http_proxy:
+        return None
+    if "://" not in http_proxy:
+        return "http://" + http_proxy
+    return http_proxy
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+"""
+Time the decoding of recorded Airbnb pages (see airbnb_replay) with each
+JSON package that is installed, and compare the old and new ways of
+getting at the data:
+
+  search pages: a walk of the whole document for "listings" keys,
+                against following the explore_tabs path
+  room pages:   four decodings of the _bootstrap-listing meta tag (one
+                per item read from it), against one
+
+    python codec_benchmark.py -d recordings -r 20
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import time
+from lxml import html
+import airbnb_codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Set up logging
+LOGGER = logging.getLogger()
+
+# Number of times the _bootstrap-listing json was decoded for each room page
+BOOTSTRAP_DECODES = 4
+
+
+def decoders():
+    """ The installed JSON packages, as (name, loads function) pairs """
+    result = [("json", json.loads)]
+    if ujson is not None:
+        result.append(("ujson", ujson.loads))
+    if orjson is not None:
+        result.append(("orjson", orjson.loads))
+    return result
+
+
+def load_recorded_pages(record_dir):
+    """
+    Return (search_pages, room_pages): the bodies of the successful
+    recorded pages, as bytes.
+    """
+    search_pages = []
+    room_pages = []
+    for meta_path in sorted(glob.glob(os.path.join(record_dir, "*.json"))):
+        with open(meta_path, encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+        if meta.get("status") != 200:
+            continue
+        body_path = meta_path[:-len(".json")] + ".body.gz"
+        with gzip.open(body_path) as body_file:
+            content = body_file.read()
+        if "/rooms/" in meta["url"]:
+            room_pages.append(content)
+        else:
+            search_pages.append(content)
+    return (search_pages, room_pages)
+
+
+def time_function(function, items, repeat):
+    """ Seconds taken to call function on every item, repeat times """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            function(item)
+    return time.perf_counter() - start
+
+
+def benchmark_search_pages(pages, repeat):
+    """ Time the ways of getting the listings from search pages """
+    results = []
+    for (name, loads) in decoders():
+        results.append(("{} + find_json_keys".format(name), time_function(
+            lambda content: airbnb_codec.find_json_keys("listings", loads(content)),
+            pages, repeat)))
+        results.append(("{} + listings_from_search_doc".format(name), time_function(
+            lambda content: airbnb_codec.listings_from_search_doc(loads(content)),
+            pages, repeat)))
+    return results
+
+
+def benchmark_room_pages(pages, repeat):
+    """ Time the decoding of the _bootstrap-listing json in room pages """
+    bootstraps = []
+    for content in pages:
+        tree = html.fromstring(content)
+        s = tree.xpath("//meta[@id='_bootstrap-listing']/@content")
+        if len(s) > 0:
+            # a plain str, as orjson does not take lxml's str subclass
+            bootstraps.append(str(s[0]))
+    results = []
+    if not bootstraps:
+        return results
+    for (name, loads) in decoders():
+        results.append(("{} x {}".format(name, BOOTSTRAP_DECODES), time_function(
+            lambda content: [loads(content) for _ in range(BOOTSTRAP_DECODES)],
+            bootstraps, repeat)))
+        results.append(("{} x 1".format(name), time_function(
+            loads, bootstraps, repeat)))
+    return results
+
+
+def report(title, results, page_count, repeat):
+    """ Print timings per page, relative to the first (the old way) """
+    if not results:
+        print("{}: no pages".format(title))
+        return
+    print("{} ({} pages, {} times)".format(title, page_count, repeat))
+    baseline = results[0][1]
+    for (name, seconds) in results:
+        print("  {:<40} {:9.3f} ms/page  {:6.2f}x".format(
+            name, 1000.0 * seconds / (page_count * repeat),
+            baseline / seconds if seconds > 0 else 0.0))
+
+
+def parse_args():
+    """
+    Read and parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Time JSON decoding of recorded Airbnb pages.")
+    parser.add_argument("-d", "--record_dir", required=True,
+                        help="directory of recorded pages (record_dir in the config file)")
+    parser.add_argument("-r", "--repeat", type=int, default=10,
+                        help="number of times to decode each page (default 10)")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main entry point for the benchmark.
+    """
+    args = parse_args()
+    logging.basicConfig(format='%(levelname)-8s%(message)s', level=logging.INFO)
+    (search_pages, room_pages) = load_recorded_pages(args.record_dir)
+    print("airbnb_codec is using {}".format(airbnb_codec.BACKEND))
+    report("Search pages", benchmark_search_pages(search_pages, args.repeat),
+           len(search_pages), args.repeat)
+    report("Room pages (_bootstrap-listing)",
+           benchmark_room_pages(room_pages, args.repeat),
+           len(room_pages), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
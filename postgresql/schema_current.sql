@@ -73,6 +73,8 @@ WITH (
   OIDS=FALSE
 );
 
+-- schema_update.py can rebuild this table partitioned by survey_id
+-- (PostgreSQL 13 or later): see partition_room_table
 CREATE TABLE public.room
 (
   room_id integer NOT NULL,
@@ -107,6 +109,40 @@ WITH (
   OIDS=FALSE
 );
 
+-- Listings copied in by surveys with db_ingest = copy, and by
+-- airbnb.py --import_rooms, before they are merged into room
+CREATE UNLOGGED TABLE public.room_staging
+(
+  room_id integer NOT NULL,
+  host_id integer,
+  room_type character varying(255),
+  country character varying(255),
+  city character varying(255),
+  neighborhood character varying(255),
+  address character varying(1023),
+  reviews integer,
+  overall_satisfaction double precision,
+  accommodates integer,
+  bedrooms numeric(5,2),
+  bathrooms numeric(5,2),
+  price double precision,
+  deleted integer,
+  minstay integer,
+  latitude numeric(30,6),
+  longitude numeric(30,6),
+  survey_id integer NOT NULL DEFAULT 999999,
+  coworker_hosted integer,
+  extra_host_languages character varying(255),
+  name character varying(255),
+  property_type character varying(255),
+  currency character varying(20),
+  rate_type character varying(20),
+  last_modified timestamp without time zone DEFAULT now()
+);
+
+CREATE INDEX room_staging_survey_id
+  ON public.room_staging (survey_id);
+
 CREATE TABLE public.schema_version
 (
   version numeric(5,2) NOT NULL,
@@ -181,6 +217,45 @@ WITH (
   OIDS=FALSE
 );
 
+CREATE TABLE public.survey_frontier_bb
+(
+  survey_id integer NOT NULL,
+  room_type character varying(255) NOT NULL DEFAULT '',
+  quadtree_node character varying(1024) NOT NULL,
+  median_node text,
+  status character varying(16) NOT NULL DEFAULT 'pending',
+  section_offset integer NOT NULL DEFAULT 0,
+  items_offset integer NOT NULL DEFAULT 0,
+  new_rooms integer NOT NULL DEFAULT 0,
+  median_lists text,
+  worker character varying(255),
+  last_modified timestamp without time zone DEFAULT now(),
+  CONSTRAINT survey_frontier_bb_pkey PRIMARY KEY (survey_id, room_type, quadtree_node)
+)
+WITH (
+  OIDS=FALSE
+);
+
+CREATE INDEX survey_frontier_bb_pending
+  ON public.survey_frontier_bb (survey_id, room_type)
+  WHERE status <> 'done';
+
+CREATE TABLE public.survey_leaf_bb
+(
+  survey_id integer NOT NULL,
+  room_type character varying(255) NOT NULL DEFAULT '',
+  quadtree_node character varying(1024) NOT NULL,
+  median_node text,
+  n_lat double precision,
+  e_lng double precision,
+  s_lat double precision,
+  w_lng double precision,
+  CONSTRAINT survey_leaf_bb_pkey PRIMARY KEY (survey_id, room_type, quadtree_node)
+)
+WITH (
+  OIDS=FALSE
+);
+
 CREATE TABLE public.zipcode
 (
   zipcode character varying(10) NOT NULL,
@@ -213,6 +213,313 @@ def add_survey_log_bb_table():
     except:
         logger.info("Table survey_progress_log_bb already exists.")
 
+def add_survey_frontier_bb_table():
+    """ The frontier of pending and completed nodes of bounding box surveys """
+    try:
+        sql = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name='survey_frontier_bb' and column_name='survey_id'
+        """
+        conn = connect()
+        cur = conn.cursor()
+        cur.execute(sql)
+        test_survey_id = cur.fetchone()[0]
+        if test_survey_id:
+            logger.info("Check: survey_frontier_bb table already has survey_id column")
+        cur.close()
+        conn.commit()
+    except TypeError:
+        # no row: the table does not exist
+        conn.commit()
+        if confirm(prompt='Create table "survey_frontier_bb"?', resp=False):
+            sql = """
+            create table survey_frontier_bb (
+                survey_id integer not null,
+                room_type varchar(255) not null default '',
+                quadtree_node varchar(1024) not null,
+                median_node text,
+                status varchar(16) not null default 'pending',
+                section_offset integer not null default 0,
+                items_offset integer not null default 0,
+                new_rooms integer not null default 0,
+                median_lists text,
+                worker varchar(255),
+                last_modified timestamp without time zone default now(),
+                constraint survey_frontier_bb_pkey
+                    primary key (survey_id, room_type, quadtree_node)
+            )
+            """
+            conn = connect()
+            cur = conn.cursor()
+            cur.execute(sql)
+            cur.execute("""
+                create index survey_frontier_bb_pending
+                on survey_frontier_bb (survey_id, room_type)
+                where status <> 'done'
+            """)
+            cur.close()
+            conn.commit()
+        else:
+            print("Table 'survey_frontier_bb' not created")
+
+    # distributed surveys record the worker holding each node
+    try:
+        sql = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name='survey_frontier_bb' and column_name='worker'
+        """
+        conn = connect()
+        cur = conn.cursor()
+        cur.execute(sql)
+        if cur.fetchone() is None:
+            logger.info("Adding worker column to survey_frontier_bb")
+            cur.execute("alter table survey_frontier_bb add column worker varchar(255)")
+        else:
+            logger.info("Check: survey_frontier_bb table already has worker column")
+        cur.close()
+        conn.commit()
+    except psycopg2.Error:
+        logger.exception("Failed to add worker column to survey_frontier_bb")
+
+def add_survey_leaf_bb_table():
+    """ Leaf rectangles of completed bounding box surveys, for warm starts """
+    try:
+        sql = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name='survey_leaf_bb' and column_name='survey_id'
+        """
+        conn = connect()
+        cur = conn.cursor()
+        cur.execute(sql)
+        test_survey_id = cur.fetchone()[0]
+        if test_survey_id:
+            logger.info("Check: survey_leaf_bb table already has survey_id column")
+        cur.close()
+        conn.commit()
+    except TypeError:
+        # no row: the table does not exist
+        conn.commit()
+        if confirm(prompt='Create table "survey_leaf_bb"?', resp=False):
+            sql = """
+            create table survey_leaf_bb (
+                survey_id integer not null,
+                room_type varchar(255) not null default '',
+                quadtree_node varchar(1024) not null,
+                median_node text,
+                n_lat double precision,
+                e_lng double precision,
+                s_lat double precision,
+                w_lng double precision,
+                constraint survey_leaf_bb_pkey
+                    primary key (survey_id, room_type, quadtree_node)
+            )
+            """
+            conn = connect()
+            cur = conn.cursor()
+            cur.execute(sql)
+            cur.close()
+            conn.commit()
+        else:
+            print("Table 'survey_leaf_bb' not created")
+
+def add_room_staging_table():
+    """ Unlogged table that listings are copied into with db_ingest = copy """
+    try:
+        sql = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name='room_staging' and column_name='survey_id'
+        """
+        conn = connect()
+        cur = conn.cursor()
+        cur.execute(sql)
+        test_survey_id = cur.fetchone()[0]
+        if test_survey_id:
+            logger.info("Check: room_staging table already has survey_id column")
+        cur.close()
+        conn.commit()
+    except TypeError:
+        # no row: the table does not exist
+        conn.commit()
+        if confirm(prompt='Create table "room_staging"?', resp=False):
+            sql = """
+            create unlogged table room_staging (
+                room_id integer not null,
+                host_id integer,
+                room_type varchar(255),
+                country varchar(255),
+                city varchar(255),
+                neighborhood varchar(255),
+                address varchar(1023),
+                reviews integer,
+                overall_satisfaction double precision,
+                accommodates integer,
+                bedrooms numeric(5,2),
+                bathrooms numeric(5,2),
+                price double precision,
+                deleted integer,
+                minstay integer,
+                latitude numeric(30,6),
+                longitude numeric(30,6),
+                survey_id integer not null default 999999,
+                coworker_hosted integer,
+                extra_host_languages varchar(255),
+                name varchar(255),
+                property_type varchar(255),
+                currency varchar(20),
+                rate_type varchar(20),
+                last_modified timestamp default now()
+            )
+            """
+            conn = connect()
+            cur = conn.cursor()
+            cur.execute(sql)
+            cur.execute("""
+            create index room_staging_survey_id on room_staging (survey_id)
+            """)
+            cur.close()
+            conn.commit()
+        else:
+            print("Table 'room_staging' not created")
+
+def room_is_partitioned():
+    """
+    True if the room table is partitioned by survey_id (as
+    airbnb_listing.room_is_partitioned)
+    """
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("""
+    select relkind = 'p' from pg_class where oid = to_regclass('room')
+    """)
+    row = cur.fetchone()
+    cur.close()
+    conn.commit()
+    return row is not None and row[0]
+
+def partition_room_table():
+    """
+    Offer to rebuild room as a table partitioned by survey_id: a partition
+    room_survey_<survey_id> for each survey, and room_default for any
+    other listings. Deleting a survey then drops its partition, and
+    queries for one survey read only its partition. The indexes and
+    grants of room are made again on the new table. This needs
+    PostgreSQL 13 or later, for the location trigger.
+    """
+    if room_is_partitioned():
+        logger.info("Check: room table is already partitioned")
+        return
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("select to_regclass('room') is not null")
+    if not cur.fetchone()[0]:
+        conn.commit()
+        return
+    cur.execute("show server_version_num")
+    if int(cur.fetchone()[0]) < 130000:
+        logger.info("Check: room table not partitioned (needs PostgreSQL 13)")
+        conn.commit()
+        return
+    # views would be left reading the old table
+    cur.execute("""
+    select distinct v.relname
+    from pg_depend d
+    join pg_rewrite r on d.objid = r.oid
+    join pg_class v on r.ev_class = v.oid
+    where d.refobjid = 'room'::regclass and v.oid <> 'room'::regclass
+    """)
+    views = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.commit()
+    if views:
+        print("Table 'room' not partitioned: views {} use it. Drop them "
+              "first, and create them again afterwards.".format(", ".join(views)))
+        return
+    if not confirm(prompt='Partition table "room" by survey_id? '
+                   '(this copies every listing)', resp=False):
+        print("Table 'room' not partitioned")
+        return
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+        select conname from pg_constraint
+        where conrelid = 'room'::regclass and contype = 'p'
+        """)
+        (pkey, ) = cur.fetchone()
+        # the other indexes and the grants are made again on the new table:
+        # index definitions name "room", which is the new table once the
+        # old one is renamed, and the old indexes are dropped to free
+        # their names
+        cur.execute("""
+        select quote_ident(i.relname), pg_get_indexdef(i.oid)
+        from pg_index x join pg_class i on x.indexrelid = i.oid
+        where x.indrelid = 'room'::regclass and not x.indisprimary
+        """)
+        indexes = cur.fetchall()
+        cur.execute("""
+        select case when a.grantee = 0 then 'public'
+                    else quote_ident(pg_get_userbyid(a.grantee)) end,
+               a.privilege_type, a.is_grantable
+        from pg_class c, aclexplode(c.relacl) a
+        where c.oid = 'room'::regclass and a.grantee <> c.relowner
+        """)
+        grants = cur.fetchall()
+        for (index_name, _) in indexes:
+            cur.execute("drop index {}".format(index_name))
+        cur.execute("alter table room rename to room_unpartitioned")
+        cur.execute("""
+        alter table room_unpartitioned
+        rename constraint {} to room_unpartitioned_pkey
+        """.format(pkey))
+        cur.execute("""
+        create table room (like room_unpartitioned including defaults)
+        partition by list (survey_id)
+        """)
+        cur.execute("""
+        alter table room add constraint room_pkey
+        primary key (room_id, survey_id)
+        """)
+        cur.execute("""
+        select survey_id from survey
+        union
+        select distinct survey_id from room_unpartitioned
+        order by 1
+        """)
+        survey_ids = [row[0] for row in cur.fetchall()]
+        for survey_id in survey_ids:
+            cur.execute("""
+            create table room_survey_{} partition of room
+            for values in (%s)
+            """.format(survey_id), (survey_id, ))
+        cur.execute("create table room_default partition of room default")
+        # the location column is copied, so the trigger is added after
+        cur.execute("insert into room select * from room_unpartitioned")
+        logger.info("%s listings copied into %s partitions",
+                    cur.rowcount, len(survey_ids))
+        cur.execute("""
+        create trigger trg_location
+        before insert or update of latitude, longitude on room
+        for each row execute procedure trg_location()
+        """)
+        # each index is also built on every partition
+        for (index_name, index_def) in indexes:
+            cur.execute(index_def)
+            logger.info("Index %s created", index_name)
+        # partitions are read through room, so the grants go on room only
+        for (grantee, privilege, grantable) in grants:
+            cur.execute("grant {} on room to {}{}".format(
+                privilege, grantee, " with grant option" if grantable else ""))
+        cur.execute("drop table room_unpartitioned")
+        cur.close()
+        conn.commit()
+        print("Table 'room' partitioned by survey_id")
+    except psycopg2.Error:
+        conn.rollback()
+        logger.exception("Table 'room' not partitioned: it is unchanged")
+
 def fix_room_table():
     try:
         sql = """
@@ -321,6 +628,10 @@ def main():
     fix_version_table()
     fix_room_table()
     add_survey_log_bb_table()
+    add_survey_frontier_bb_table()
+    add_survey_leaf_bb_table()
+    add_room_staging_table()
+    partition_room_table()
 
 
 if __name__ == "__main__":